@@ -1,20 +1,491 @@
 import pyabf
 import numpy as np
 import os
-import glob
 import json
+import sys
+import time
+import zlib
+import struct
+import itertools
+import h5py
+from functools import partial
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dateutil.tz import tzlocal
 from pynwb import NWBHDF5IO, NWBFile
-from pynwb.icephys import CurrentClampStimulusSeries, VoltageClampStimulusSeries, CurrentClampSeries, VoltageClampSeries
+from pynwb.core import DynamicTable, VectorData
+from pynwb.icephys import PatchClampSeries, CurrentClampStimulusSeries, VoltageClampStimulusSeries, CurrentClampSeries, VoltageClampSeries
 from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk, DataChunkIterator
+from hdmf.utils import get_docval
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+try:
+    import numcodecs
+    from hdmf_zarr import ZarrDataIO
+    from hdmf_zarr.nwb import NWBZarrIO
+except ImportError:  # Only needed for the zarr output backend
+    NWBZarrIO = None
+
+from ABF1Reader import ABF1Reader
+
+# Number of samples pulled from the ABF file per chunk when streaming
+STREAMING_CHUNK_SAMPLES = 65536
+
+# Dataset settings selectable by name, "auto" is resolved by autoTuneCompression
+COMPRESSION_PROFILES = {
+    "default": dict(compression=True, chunks=True, shuffle=True, fletcher32=True),
+    "fast": dict(compression="lzf", chunks=True, shuffle=True),
+    "archival": dict(compression="gzip", compression_opts=9, chunks=True, shuffle=True, fletcher32=True),
+    "none": dict(),
+}
+
+# Codecs and chunk sizes (in samples) tried by autoTuneCompression
+AUTO_COMPRESSION_CODECS = [
+    dict(),
+    dict(compression="lzf", shuffle=True),
+    dict(compression="gzip", compression_opts=1, shuffle=True, fletcher32=True),
+    dict(compression="gzip", compression_opts=4, shuffle=True, fletcher32=True),
+    dict(compression="gzip", compression_opts=9, shuffle=True, fletcher32=True),
+]
+AUTO_COMPRESSION_CHUNK_SAMPLES = [4096, 16384, 65536]
+
+# Read patterns the chunk shapes can be chosen for, see getReadPatternChunks
+READ_PATTERNS = ["sweep", "window", "rows"]
+
+# Upper bound for the size of a chunk, the size of the default HDF5 chunk cache
+MAX_CHUNK_BYTES = 1 << 20
+
+# Lower bound for the samples of a windowed chunk, so that compression stays effective
+MIN_CHUNK_SAMPLES = 1024
+
+# Bounds and base of the chunk size in bytes for chunks=True, as used by h5py, see guessChunkShape
+GUESS_CHUNK_BASE = 16 * 1024
+GUESS_CHUNK_MIN = 8 * 1024
+GUESS_CHUNK_MAX = 1024 * 1024
+
+# Storage formats of the output file, see ABF1Converter
+OUTPUT_BACKENDS = ["hdf5", "zarr"]
+
+# Number of sweeps of the first file converted in memory to calibrate the estimates of a dry run
+CALIBRATION_SWEEPS = 2
+
+def peakMemory():
+    """
+    Returns the peak resident memory of the process in bytes, or None where it can not be determined.
+    """
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 
-def createCompressedDataset(array):
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def getOutputSize(path):
+    """
+    Returns the size in bytes of an output file, or of all files of a directory store.
+    """
+
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum([os.path.getsize(os.path.join(dirpath, fileName))
+                for dirpath, dirnames, filenames in os.walk(path) for fileName in filenames])
+
+def createCompressedDataset(array, settings=COMPRESSION_PROFILES["default"]):
     """
     Request compression for the given array and return it wrapped.
+
+    settings are the H5DataIO arguments of a compression profile. Explicit chunk sizes apply to the sample
+    axis and are limited to the number of samples, a 2-D array of sweeps is chunked one sweep at a time,
+    unless the chunk shape has a size for every axis.
+    """
+
+    return H5DataIO(data=array, **getCompressionArguments(array, settings))
+
+def getCompressionArguments(array, settings):
+    """
+    Returns the H5DataIO arguments of a compression profile for the given array, see createCompressedDataset.
+    """
+
+    settings = dict(settings)
+
+    if isinstance(settings.get("chunks"), tuple):
+        if isinstance(array, AbstractDataChunkIterator):
+            shape = array.maxshape
+        else:
+            shape = np.shape(array)
+        settings["chunks"] = limitChunkShape(settings["chunks"], shape)
+
+    return settings
+
+def limitChunkShape(chunks, shape):
+    """
+    Returns an explicit chunk shape for an array, limited to its shape.
+
+    A chunk shape with fewer axes than the array gives the size along the sample axis, with one sweep per chunk.
+    """
+
+    if len(chunks) != len(shape):
+        chunks = (1,) * (len(shape) - 1) + (chunks[-1],)
+
+    return tuple([max(1, min(chunkSize, size)) for chunkSize, size in zip(chunks, shape)])
+
+def getReadPatternChunks(readPattern, shape, dtype, rate, readWindow):
+    """
+    Returns the chunk shape of a (samples) series or a (sweeps x samples) stacked dataset for a read pattern.
+
+    "sweep" stores every sweep in as few chunks as fit into MAX_CHUNK_BYTES, so that a whole sweep is read in one
+    go. "window" uses chunks of readWindow seconds of samples, so that a short window decompresses little more
+    than itself. "rows" additionally spans as many sweeps per chunk as fit, for reading the same window across
+    the sweeps of a stacked dataset.
+    """
+
+    sampleCount = shape[-1]
+    maxSamples = max(1, MAX_CHUNK_BYTES // np.dtype(dtype).itemsize)
+
+    if readPattern == "sweep":
+        chunkCount = max(1, -(-sampleCount // maxSamples))
+        samples = -(-sampleCount // chunkCount)
+    else:
+        samples = min(max(MIN_CHUNK_SAMPLES, int(round(rate * readWindow))), maxSamples)
+
+    samples = max(1, min(samples, sampleCount))
+    rows = 1
+
+    if readPattern == "rows" and len(shape) == 2:
+        rows = max(1, min(shape[0], maxSamples // samples))
+
+    return (rows,) * (len(shape) - 1) + (samples,)
+
+def createZarrDataset(array, settings=COMPRESSION_PROFILES["default"]):
+    """
+    Request the zarr codecs closest to the given compression profile for the array and return it wrapped.
+
+    gzip keeps its level, LZF has no zarr codec and is replaced by LZ4 in Blosc, and shuffle and fletcher32 become
+    filters. The chunks are shaped as by HDF5, every chunk is stored in a file of its own.
+    """
+
+    if isinstance(array, AbstractDataChunkIterator):
+        shape = array.maxshape
+    else:
+        shape = np.shape(array)
+
+    compression = settings.get("compression")
+    filters = []
+
+    if compression in (True, "gzip"):
+        if settings.get("shuffle"):
+            filters.append(numcodecs.Shuffle(elementsize=np.dtype(array.dtype).itemsize))
+        compressor = numcodecs.GZip(level=settings.get("compression_opts") or 4)
+    elif compression == "lzf":
+        shuffle = numcodecs.Blosc.SHUFFLE if settings.get("shuffle") else numcodecs.Blosc.NOSHUFFLE
+        compressor = numcodecs.Blosc(cname="lz4", shuffle=shuffle)
+    else:
+        compressor = False
+
+    if settings.get("fletcher32"):
+        filters.append(numcodecs.Fletcher32())
+
+    return ZarrDataIO(data=array, chunks=getChunkShape(settings, shape, array.dtype), compressor=compressor,
+                      filters=filters or None)
+
+def supportsDirectChunks(settings):
+    """
+    Checks whether the chunks of a compression profile can be compressed outside of HDF5, which is the case
+    for gzip with optional shuffle and checksum.
+    """
+
+    return (settings.get("compression") in (True, "gzip")
+            and set(settings) <= {"compression", "compression_opts", "chunks", "shuffle", "fletcher32"})
+
+def getChunkShape(settings, shape, dtype):
+    """
+    Returns the chunk shape HDF5 uses for an array of the given shape with the settings of a compression profile.
+
+    Explicit chunk sizes are applied as in createCompressedDataset, chunks=True is resolved as h5py does.
     """
 
-    return H5DataIO(data=array, compression=True, chunks=True, shuffle=True, fletcher32=True)
+    chunks = settings.get("chunks", True)
+
+    if isinstance(chunks, tuple):
+        return limitChunkShape(chunks, shape)
+
+    return guessChunkShape(shape, np.dtype(dtype).itemsize)
+
+def guessChunkShape(shape, itemSize):
+    """
+    Returns the chunk shape h5py picks for chunks=True, so that direct chunk writes lay out a dataset as HDF5 would.
+
+    The target size grows with the size of the dataset, and the axes are halved in turn until the chunk is close to it.
+    """
+
+    shape = tuple(size if size != 0 else 1024 for size in shape)
+
+    if len(shape) == 0:
+        raise ValueError("Chunks are not allowed for scalar datasets.")
+
+    chunks = np.array(shape, dtype="=f8")
+    datasetBytes = np.prod(chunks) * itemSize
+    targetBytes = min(max(GUESS_CHUNK_BASE * (2 ** np.log10(datasetBytes / (1024. * 1024))), GUESS_CHUNK_MIN),
+                      GUESS_CHUNK_MAX)
+
+    axis = 0
+    while True:
+        chunkBytes = np.prod(chunks) * itemSize
+
+        if ((chunkBytes < targetBytes or abs(chunkBytes - targetBytes) / targetBytes < 0.5)
+                and chunkBytes < GUESS_CHUNK_MAX):
+            break
+
+        # Element larger than the maximum chunk size
+        if np.prod(chunks) == 1:
+            break
+
+        chunks[axis % len(shape)] = np.ceil(chunks[axis % len(shape)] / 2.0)
+        axis += 1
+
+    return tuple(int(size) for size in chunks)
+
+def fletcher32(buffer):
+    """
+    Returns the Fletcher-32 checksum of a buffer as computed by the HDF5 fletcher32 filter.
+
+    HDF5 folds the sums every 360 16-bit words, the sums of these blocks are computed with numpy.
+    """
+
+    wordCount = len(buffer) // 2
+    words = np.frombuffer(buffer, dtype=">u2", count=wordCount).astype(np.int64)
+
+    # Each word is added to sum1 once, and to sum2 once for every remaining word of its block
+    fullWords = wordCount - wordCount % 360
+    fullBlocks = words[:fullWords].reshape(-1, 360)
+    blocks = list(zip([360] * len(fullBlocks), fullBlocks.sum(axis=1).tolist(),
+                      (fullBlocks @ np.arange(360, 0, -1)).tolist()))
+
+    if fullWords < wordCount:
+        block = words[fullWords:]
+        blocks += [(len(block), int(block.sum()), int(np.dot(block, np.arange(len(block), 0, -1))))]
+
+    if len(buffer) % 2:
+        blocks += [(1, buffer[-1] << 8, buffer[-1] << 8)]
+
+    sum1 = sum2 = 0
+    for length, blockSum, weightedSum in blocks:
+        sum2 += length * sum1 + weightedSum
+        sum1 += blockSum
+        sum1 = (sum1 & 0xffff) + (sum1 >> 16)
+        sum2 = (sum2 & 0xffff) + (sum2 >> 16)
+
+    sum1 = (sum1 & 0xffff) + (sum1 >> 16)
+    sum2 = (sum2 & 0xffff) + (sum2 >> 16)
+
+    return (sum2 << 16) | sum1
+
+def compressChunk(chunk, settings):
+    """
+    Applies the shuffle, gzip and fletcher32 filters of a compression profile to one chunk of data, in the order
+    used by h5py, and returns the bytes HDF5 stores for it.
+
+    zlib releases the GIL, so chunks can be compressed concurrently in threads.
+    """
+
+    buffer = np.ascontiguousarray(chunk).tobytes()
+
+    if settings.get("shuffle"):
+        buffer = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, chunk.dtype.itemsize).T.tobytes()
+
+    buffer = zlib.compress(buffer, settings.get("compression_opts") or 4)
+
+    if settings.get("fletcher32"):
+        buffer += struct.pack("<I", fletcher32(buffer))
+
+    return buffer
+
+def iterateChunks(array, chunkShape):
+    """
+    Yields the offset and the data of every chunk of an array, edge chunks padded with zeros to the full chunk shape.
+
+    The array can also be a SweepDataChunkIterator, whose chunks are then read one after the other as they are
+    requested.
+    """
+
+    if isinstance(array, AbstractDataChunkIterator):
+        shape = array.maxshape
+    else:
+        shape = array.shape
+
+    ranges = [range(0, size, chunkSize) for size, chunkSize in zip(shape, chunkShape)]
+
+    for offset in itertools.product(*ranges):
+        selection = tuple(slice(start, start + chunkSize) for start, chunkSize in zip(offset, chunkShape))
+        chunk = array[selection]
+
+        if chunk.shape != tuple(chunkShape):
+            padded = np.zeros(chunkShape, dtype=array.dtype)
+            padded[tuple(slice(0, size) for size in chunk.shape)] = chunk
+            chunk = padded
+
+        yield offset, chunk
+
+class DirectChunkPlaceholder(AbstractDataChunkIterator):
+
+    """
+    Stands in for an array whose chunks are compressed and written directly after the NWB file is written.
+
+    Yields no data, so that only the dataset is created, with the shape and type of the array.
+
+    Parameters
+    ----------
+    shape: shape of the array
+    dtype: data type of the array
+    chunkShape: chunk shape of the dataset
+    """
+
+    def __init__(self, shape, dtype, chunkShape):
+
+        self.shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self.chunkShape = tuple(chunkShape)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        raise StopIteration
+
+    def recommended_chunk_shape(self):
+        return self.chunkShape
+
+    def recommended_data_shape(self):
+        return self.shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        return self.shape
+
+def autoTuneCompression(samples, timeBudget):
+    """
+    Trial-compresses sample sweeps with every codec and chunk size and returns the settings of the smallest
+    output which is written within timeBudget seconds per MB of sweep data.
+
+    Falls back to the fastest settings when none meets the budget.
+    """
+
+    sampleBytes = sum(sample.nbytes for sample in samples)
+    trials = []
+
+    with h5py.File("autoTuneCompression", "w", driver="core", backing_store=False) as f:
+        for codecIndex, codec in enumerate(AUTO_COMPRESSION_CODECS):
+
+            # Uncompressed datasets are stored contiguously, so the chunk size does not matter
+            chunkSizes = AUTO_COMPRESSION_CHUNK_SAMPLES if codec else [None]
+
+            for chunkSize in chunkSizes:
+                settings = dict(codec)
+                if chunkSize is not None:
+                    settings["chunks"] = (chunkSize,)
+
+                startTime = time.perf_counter()
+                storedBytes = 0
+                for sampleIndex, sample in enumerate(samples):
+                    dsetSettings = dict(settings)
+                    if chunkSize is not None:
+                        dsetSettings["chunks"] = (min(chunkSize, len(sample)),)
+                    dset = f.create_dataset(f"{codecIndex}_{chunkSize}_{sampleIndex}", data=sample, **dsetSettings)
+                    storedBytes += dset.id.get_storage_size()
+                elapsed = time.perf_counter() - startTime
+
+                trials.append((settings, storedBytes, elapsed / (sampleBytes / 1e6)))
+
+    withinBudget = [trial for trial in trials if trial[2] <= timeBudget]
+
+    if withinBudget:
+        settings, storedBytes, secondsPerMB = min(withinBudget, key=lambda trial: (trial[1], trial[2]))
+    else:
+        settings, storedBytes, secondsPerMB = min(trials, key=lambda trial: trial[2])
+
+    print(f"Auto compression selected {settings}: ratio {sampleBytes / max(storedBytes, 1):.2f}, "
+          f"{secondsPerMB:.4f} s/MB.")
+
+    return settings
+
+class SweepDataChunkIterator(AbstractDataChunkIterator):
+
+    """
+    Pulls the samples of a single sweep from its source only when the NWB file is written.
+
+    Parameters
+    ----------
+    readSamples: callable returning the samples in [start, stop) of the sweep
+    sampleCount: number of samples in the sweep
+    dtype: data type of the returned samples
+    chunkSize: number of samples requested from readSamples at once
+    """
+
+    def __init__(self, readSamples, sampleCount, dtype, chunkSize=STREAMING_CHUNK_SAMPLES):
+
+        self.readSamples = readSamples
+        self.sampleCount = sampleCount
+        self._dtype = np.dtype(dtype)
+        self.chunkSize = max(1, min(chunkSize, sampleCount))
+        self._position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+
+        if self._position >= self.sampleCount:
+            raise StopIteration
+
+        start = self._position
+        stop = min(start + self.chunkSize, self.sampleCount)
+        self._position = stop
+
+        return DataChunk(data=self.readSamples(start, stop), selection=np.s_[start:stop])
+
+    def __getitem__(self, selection):
+        """
+        Reads the samples of a slice of the sweep, given as a tuple as by iterateChunks.
+        """
+
+        start, stop, _ = selection[0].indices(self.sampleCount)
+
+        return self.readSamples(start, stop)
+
+    def copy(self):
+        """
+        Returns a new iterator over the same samples, starting from the first one.
+        """
+
+        return SweepDataChunkIterator(self.readSamples, self.sampleCount, self._dtype, self.chunkSize)
+
+    def recommended_chunk_shape(self):
+        return None
+
+    def recommended_data_shape(self):
+        return (self.sampleCount,)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        return (self.sampleCount,)
 
 class ABF1Converter:
 
@@ -22,75 +493,669 @@ class ABF1Converter:
     Converts Neuron2BrainLab's ABF1 files from a single cell (collected without amplifier settings from the
     multi-clamp commander) to a collective NeurodataWithoutBorders v2 file.
 
-    Modeled after ABFConverter created by the Allen Institute.
+    Modeled after ABFConverter created by the Allen Institute.
+
+    Parameters
+    ----------
+    inputPath: path to ABF file or a folder of ABF files to be converted
+    outputFilePath: path to the output NWB file
+    gain: user-input value
+    acquisitionChannelName: Allows to output only a specific acquisition channel, defaults to all
+    stimulusChannelName: Allows to output only a specific stimulus channel,
+                         defaults to all. The name can also be an AD channel name for cases where
+                         the stimulus is recorded as well.
+    streaming: Read the sweep data from the ABF files while the NWB file is written instead of
+               holding every sweep in memory, defaults to False
+    nativeReader: Read the sweep data through the memory-mapped ABF1Reader instead of pyabf, defaults to False.
+                  Streaming always uses the native reader.
+    rawData: Store the recorded int16 ADC counts instead of scaled floats, with the ABF gain and offset folded
+             into the conversion (and offset) of the series, defaults to False. Uses the native reader.
+    compression: Name of the compression profile, one of COMPRESSION_PROFILES or "auto", defaults to "default"
+    compressionTimeBudget: Seconds per MB of sweep data allowed for compression by the "auto" profile
+    layout: "series" writes one series per sweep and channel, "stacked" writes the equal-length sweeps of each
+            channel as one (sweeps x samples) dataset with a per-sweep index, defaults to "series"
+    sweepTable: Write the file and protocol metadata once per sweep into a table and only reference its row from
+                the series descriptions, instead of repeating it as JSON in every description, defaults to False
+    append: Add the ABF files which are not yet present in an existing output file to it, instead of writing a new
+            file. Files are identified by the file name stored in the series descriptions, defaults to False
+    profile: Record the wall time, bytes in and out, sweeps per second and peak memory of every conversion stage
+             into profileReport, defaults to False
+    maxMemory: Budget in bytes for the sweep data held in memory. The sweeps are streamed into the output file,
+               which is written once, and a ValueError is raised before converting if the largest block of sweep
+               data read at once does not fit, see _getSweepBytes. Defaults to None (no budget)
+    compressionThreads: Number of threads compressing the chunks of in-memory sweep data, which are then written
+                        directly to HDF5. Used with gzip profiles and the hdf5 backend only, defaults to 1
+                        (compressed by HDF5)
+    dryRun: Only estimate the size and conversion time of the output file per compression profile into
+            conversionPlan, from the headers and a trial conversion of a few sweeps in memory, without writing
+            anything, defaults to False
+    backend: "hdf5" writes a single NWB file, "zarr" writes the same structure into a zarr directory store with
+             every chunk in a file of its own, so that chunks can be read without HDF5 locking. Requires hdmf-zarr,
+             and does not support append, defaults to "hdf5"
+    readPattern: How the sweep data will mostly be read, which sets the chunk shapes of the chunked datasets,
+                 see getReadPatternChunks: "sweep" for whole sweeps, "window" for short windows of readWindow
+                 seconds, "rows" for the same window across the sweeps of the stacked layout. The pattern is
+                 recorded as JSON in the notes of the file. Defaults to None, with the chunks of the compression
+                 profile
+    readWindow: Length in seconds of the windows read with the "window" and "rows" patterns, defaults to 0.1
+    """
+
+    def __init__(self, inputPath, outputFilePath, gain=None, acquisitionChannelName=None, stimulusChannelName=None,
+                 streaming=False, nativeReader=False, rawData=False, compression="default", compressionTimeBudget=0.05,
+                 layout="series", sweepTable=False, append=False, profile=False, maxMemory=None,
+                 compressionThreads=1, dryRun=False, backend="hdf5", readPattern=None, readWindow=0.1):
+
+        self.inputPath = inputPath
+        self.debug=False
+
+        if os.path.isfile(self.inputPath):
+            print(inputPath)
+
+            self.fileNames = [os.path.basename(self.inputPath)]
+            self.abfFiles = [self._readHeader(self.inputPath)]
+
+        elif os.path.isdir(self.inputPath):
+            abfFiles = []
+            for dirpath, dirnames, filenames in os.walk(self.inputPath):
+
+                # Find all .abf files in the leaf directories, from the listing os.walk already made
+                if len(dirnames) == 0:
+                    abfFiles += [os.path.join(dirpath, fileName) for fileName in filenames
+                                 if fileName.endswith(".abf")]
+
+            if len(abfFiles) == 0:
+                raise ValueError(f"{inputPath} contains no ABF Files.")
+
+            # Arrange the ABF files in ascending order
+            abfFiles.sort(key=lambda x: os.path.basename(x))
+
+            # Collect file names for description
+            self.fileNames = []
+            for file in abfFiles:
+                self.fileNames += [os.path.basename(file)]
+
+            self.abfFiles = []
+            for abfFile in abfFiles:
+                self.abfFiles += [self._readHeader(abfFile)]
+
+        self.outputPath = outputFilePath
+
+        # Take metadata input, and return hard coded values for None
+
+        if gain:
+            self.gain = gain
+        else:
+            self.gain = 1.0
+
+        self.acquisitionChannelName = acquisitionChannelName
+        self.stimulusChannelName    = stimulusChannelName
+        self.streaming              = streaming
+        self.nativeReader           = nativeReader
+        self.rawData                = rawData
+
+        if compression != "auto" and compression not in COMPRESSION_PROFILES:
+            raise ValueError(f"Unknown compression profile {compression}.")
+
+        self.compression            = compression
+        self.compressionTimeBudget  = compressionTimeBudget
+
+        if layout not in ("series", "stacked"):
+            raise ValueError(f"Unknown layout {layout}.")
+
+        self.layout                 = layout
+        self.sweepTable             = sweepTable
+
+        # Series descriptions by (file index, sweep number), shared by the stimulus and acquisition of a sweep
+        self._descriptions = {}
+
+        if append and (sweepTable or layout != "series"):
+            raise ValueError("Appending is only supported for the series layout without a sweep table.")
+
+        self.append                 = append
+
+        # Index of the first ABF file in the series names, non-zero when appending to an existing file
+        self.firstFileIndex         = 0
+
+        # Memory-mapped readers, opened on demand for each ABF file
+        self._readers = {}
+
+        # ABF file whose sweep data pyabf holds, see _loadSweepData
+        self._loadedFile = None
+
+        # Last generated command waveform by (ABF file, sweep, channel), see _readDACSamples
+        self._dacWaveform = None
+
+        self.profile                = profile
+        self.profileReport          = None
+
+        if maxMemory is not None and maxMemory <= 0:
+            raise ValueError(f"Invalid memory budget {maxMemory}: must be positive.")
+
+        self.maxMemory              = maxMemory
+
+        # Under a memory budget only a chunk of each sweep is held at a time
+        if maxMemory is not None:
+            self.streaming = True
+
+        # Open output file while the series of new ABF files are added to it, see _appendToNWBFile
+        self._batchIO               = None
+
+        if compressionThreads < 1:
+            raise ValueError(f"Invalid number of compression threads {compressionThreads}: must be at least 1.")
+
+        self.compressionThreads     = compressionThreads
+
+        # (dataset path, array, settings) of the datasets whose chunks are written by _writeDirectChunks
+        self._directChunks          = []
+
+        self.dryRun                 = dryRun
+        self.conversionPlan         = None
+
+        if backend not in OUTPUT_BACKENDS:
+            raise ValueError(f"Unknown backend {backend}.")
+
+        if backend == "zarr":
+            if NWBZarrIO is None:
+                raise ImportError("The zarr backend requires hdmf-zarr.")
+
+            # Appending reads and writes the existing file through NWBHDF5IO
+            if append:
+                raise ValueError("The zarr backend does not support appending.")
+
+        self.backend                = backend
+
+        if readPattern is not None and readPattern not in READ_PATTERNS:
+            raise ValueError(f"Unknown read pattern {readPattern}.")
+
+        if readWindow <= 0:
+            raise ValueError(f"Invalid read window {readWindow}: must be positive.")
+
+        self.readPattern            = readPattern
+        self.readWindow             = readWindow
+
+    def _readHeader(self, abfFilePath):
+        """
+        Reads only the header of an ABF file and checks its version.
+
+        The sweep data is loaded on demand during conversion, see _loadSweepData.
+        """
+
+        abf = pyabf.ABF(abfFilePath, loadData=False)
+
+        if abf.abfVersion["major"] != 1:
+            raise ValueError(f"The ABF version for the file {abf} is not supported.")
+
+        return abf
+
+    def _loadSweepData(self, abfFile):
+        """
+        Loads the sweep data of a header-only ABF file through pyabf.
+
+        The sweep data of the file loaded before is dropped, so that pyabf only holds one file at a time.
+        """
+
+        if abfFile is self._loadedFile:
+            return
+
+        self._unloadSweepData()
+
+        with open(abfFile.abfFilePath, "rb") as fb:
+            abfFile._loadAndScaleData(fb)
+
+        self._loadedFile = abfFile
+
+    def _unloadSweepData(self):
+        """
+        Drops the sweep data loaded by pyabf.
+        """
+
+        if self._loadedFile is not None:
+            del self._loadedFile.data
+            self._loadedFile = None
+
+        self._dacWaveform = None
+
+    def _usesNativeReader(self):
+        # pyabf decodes all sweeps of a file at once, which does not fit streaming
+        return self.streaming or self.nativeReader or self.rawData
+
+    def _storesRawData(self, abfFile, channelIndex, isADC):
+        """
+        Checks whether the int16 counts of a channel are stored instead of the scaled data.
+
+        Only recorded ADC data has counts, the command waveforms are always stored scaled.
+        """
+
+        if not self.rawData or not isADC:
+            return False
+
+        offset = abfFile._dataOffset[channelIndex]
+        seriesArgs = [arg["name"] for arg in get_docval(PatchClampSeries.__init__)]
+
+        if offset != 0 and "offset" not in seriesArgs:
+            raise ValueError(f"The channel {channelIndex} of {abfFile.abfFilePath} has an offset of {offset}, "
+                             f"which this version of pynwb can not store alongside raw data.")
+
+        return True
+
+    def _getScaling(self, abfFile, channelIndex, scaledUnit, isADC):
+        """
+        Returns the scaling arguments of a series and its base unit.
+
+        For raw data the ABF gain and offset are folded into the conversion and offset.
+        """
+
+        conversion, unit = self._unitConversion(scaledUnit)
+        scaling = {"conversion": conversion}
+
+        if self._storesRawData(abfFile, channelIndex, isADC):
+            reader = self._getReader(abfFile)
+            scaling["conversion"] = reader.gain[channelIndex] * conversion
+
+            if reader.offset[channelIndex] != 0:
+                scaling["offset"] = reader.offset[channelIndex] * conversion
+
+        return scaling, unit
+
+    def _getReader(self, abfFile):
+        """
+        Returns the memory-mapped reader of an ABF file, opening it on first use.
+        """
+
+        if abfFile.abfFilePath not in self._readers:
+            self._readers[abfFile.abfFilePath] = ABF1Reader(abfFile)
+
+        return self._readers[abfFile.abfFilePath]
+
+    def _closeReaders(self):
+
+        for reader in self._readers.values():
+            reader.close()
+
+        self._readers = {}
+
+    def _readADCSamples(self, abfFile, sweepNumber, channelIndex, start, stop):
+        """
+        Reads and scales the samples in [start, stop) of one ADC channel of a sweep through the native reader.
+
+        The scaling matches the one applied by pyabf, so the result is identical to sweepY.
+        """
+
+        return self._getReader(abfFile).sweep(sweepNumber, channelIndex, start, stop)
+
+    def _readLoadedSamples(self, abfFile, sweepNumber, channelIndex, start, stop):
+        """
+        Returns the samples in [start, stop) of one ADC channel of a sweep from the data loaded by pyabf, as sweepY.
+
+        The file is loaded on first use, see _loadSweepData.
+        """
+
+        self._loadSweepData(abfFile)
+
+        offset = sweepNumber * abfFile.sweepPointCount
+
+        return abfFile.data[channelIndex, offset + start:offset + stop]
+
+    def _readDACSamples(self, abfFile, sweepNumber, channelIndex, start, stop):
+        """
+        Generates the samples in [start, stop) of the command waveform of a sweep, as sweepC does.
+
+        The waveform is generated as a whole, so the last one is kept for the following chunks of the same sweep.
+        """
+
+        key = (abfFile.abfFilePath, sweepNumber, channelIndex)
+
+        if self._dacWaveform is None or self._dacWaveform[0] != key:
+            waveform = abfFile.stimulusByChannel[channelIndex].stimulusWaveform(sweepNumber)
+            self._dacWaveform = key, waveform[:abfFile.sweepPointCount]
+
+        return self._dacWaveform[1][start:stop]
+
+    def _getSweepData(self, abfFile, sweepNumber, channelIndex, isADC):
+        """
+        Returns the data and the scaled unit of one channel of a sweep.
+
+        isADC selects the recorded ADC data (sweepY) instead of the command waveform (sweepC).
+        In streaming mode and with pyabf the data is a SweepDataChunkIterator which reads the samples at write
+        time, so that pyabf holds the data of one file at a time instead of all of them until the file is written.
+        """
+
+        sampleCount = abfFile.sweepPointCount
+
+        if self._storesRawData(abfFile, channelIndex, isADC):
+            reader = self._getReader(abfFile)
+            scaledUnit = abfFile._getAdcNameAndUnits(channelIndex)[1]
+
+            if self.streaming:
+                readSamples = partial(reader.rawSweep, sweepNumber, channelIndex)
+                data = SweepDataChunkIterator(readSamples, abfFile.sweepPointCount, np.int16)
+            else:
+                data = np.ascontiguousarray(reader.rawSweep(sweepNumber, channelIndex))
+
+            return data, scaledUnit
+
+        if self._usesNativeReader() and not self.streaming:
+            if isADC:
+                data = self._readADCSamples(abfFile, sweepNumber, channelIndex, 0, sampleCount)
+                scaledUnit = abfFile._getAdcNameAndUnits(channelIndex)[1]
+            else:
+                data = self._readDACSamples(abfFile, sweepNumber, channelIndex, 0, sampleCount)
+                scaledUnit = abfFile._getDacNameAndUnits(channelIndex)[1]
+
+            return data, scaledUnit
+
+        if isADC and self.streaming:
+            readSamples = partial(self._readADCSamples, abfFile, sweepNumber, channelIndex)
+            data = SweepDataChunkIterator(readSamples, sampleCount, np.float32)
+            scaledUnit = abfFile._getAdcNameAndUnits(channelIndex)[1]
+        elif isADC:
+            # pyabf decodes the whole file at once, so the sweep is handed over in a single chunk
+            readSamples = partial(self._readLoadedSamples, abfFile, sweepNumber, channelIndex)
+            data = SweepDataChunkIterator(readSamples, sampleCount, np.float32, chunkSize=sampleCount)
+            scaledUnit = abfFile._getAdcNameAndUnits(channelIndex)[1]
+        else:
+            # The command waveform is generated as a whole, so it is handed over in a single chunk
+            readSamples = partial(self._readDACSamples, abfFile, sweepNumber, channelIndex)
+            data = SweepDataChunkIterator(readSamples, sampleCount, np.float64, chunkSize=sampleCount)
+            scaledUnit = abfFile._getDacNameAndUnits(channelIndex)[1]
+
+        return data, scaledUnit
+
+    def _readSweep(self, abfFile, sweepNumber, channelIndex, isADC):
+        """
+        Returns the data of one channel of a sweep as an array, also when it is read at write time.
+        """
+
+        data, _ = self._getSweepData(abfFile, sweepNumber, channelIndex, isADC)
+
+        if isinstance(data, SweepDataChunkIterator):
+            data = data.readSamples(0, data.sampleCount)
+
+        return data
+
+    def _decodeSweep(self, abfFile, sweepNumber, channels):
+        """
+        Returns the data and the scaled unit of several channels of a sweep, by (channel index, isADC).
+
+        With the native reader the ADC channels are taken from the interleaved sweep block in a single read, and
+        each command waveform is generated once, however many series it is routed to.
+        In streaming mode and with pyabf the data are SweepDataChunkIterators, which read the samples at write time.
+        """
+
+        if self.streaming or not self._usesNativeReader():
+            return {channel: self._getSweepData(abfFile, sweepNumber, *channel) for channel in set(channels)}
+
+        sampleCount = abfFile.sweepPointCount
+        adcChannels = sorted({channelIndex for channelIndex, isADC in channels if isADC})
+        dacChannels = sorted({channelIndex for channelIndex, isADC in channels if not isADC})
+
+        if not adcChannels:
+            adcData = {}
+        else:
+            # Raw data is stored for either all or none of the ADC channels
+            raw = all([self._storesRawData(abfFile, channelIndex, True) for channelIndex in adcChannels])
+            adcData = self._getReader(abfFile).sweepChannels(sweepNumber, adcChannels, raw=raw)
+
+        sweep = {}
+
+        for channelIndex in adcChannels:
+            sweep[(channelIndex, True)] = adcData[channelIndex], abfFile._getAdcNameAndUnits(channelIndex)[1]
+
+        for channelIndex in dacChannels:
+            data = self._readDACSamples(abfFile, sweepNumber, channelIndex, 0, sampleCount)
+            sweep[(channelIndex, False)] = data, abfFile._getDacNameAndUnits(channelIndex)[1]
+
+        return sweep
+
+    def _takeSweepData(self, sweep, channel):
+        """
+        Returns the data and the scaled unit of a channel of a decoded sweep, for one series.
+
+        An iterator is consumed by the series it is written to, so a channel routed to several series hands a
+        fresh copy to each of them.
+        """
+
+        data, scaledUnit = sweep[channel]
+
+        if isinstance(data, SweepDataChunkIterator):
+            sweep[channel] = data.copy(), scaledUnit
+
+        return data, scaledUnit
+
+    def _getStimulusChannels(self, abfFile):
+        """
+        Returns the channel names, the selected channel indices and whether these are DAC channels,
+        for the stimulus of an ABF file.
+        """
+
+        isStimulus = True
+
+        if self.stimulusChannelName is None:
+            channelList = abfFile.adcNames
+            channelIndices = range(len(channelList))
+        else:
+            if self.stimulusChannelName in abfFile.dacNames:
+                channelList = abfFile.dacNames
+                channelIndices = [channelList.index(self.stimulusChannelName)]
+            elif self.stimulusChannelName in abfFile.adcNames:
+                isStimulus = False
+                channelList = abfFile.adcNames
+                channelIndices = [channelList.index(self.stimulusChannelName)]
+            else:
+                raise ValueError(f"Channel {self.stimulusChannelName} could not be found.")
+
+        return channelList, channelIndices, isStimulus
+
+    def _getAcquisitionChannels(self, abfFile):
+        """
+        Returns the channel names and the selected channel indices for the acquisition of an ABF file.
+        """
+
+        if self.acquisitionChannelName is None:
+            channelList = abfFile.adcNames
+            channelIndices = range(len(channelList))
+        else:
+            if self.acquisitionChannelName in abfFile.adcNames:
+                channelList = abfFile.adcNames
+                channelIndices = [channelList.index(self.acquisitionChannelName)]
+            else:
+                raise ValueError(f"Channel {self.acquisitionChannelName} could not be found.")
+
+        return channelList, channelIndices
+
+    def _getSweepChannels(self, abfFile):
+        """
+        Returns the (channel index, isADC) pairs routed to the stimulus and to the acquisition series of an ABF file.
+        """
+
+        _, stimulusIndices, isStimulus = self._getStimulusChannels(abfFile)
+        _, acquisitionIndices = self._getAcquisitionChannels(abfFile)
+
+        stimulusChannels = [(channelIndex, not isStimulus) for channelIndex in stimulusIndices]
+        acquisitionChannels = [(channelIndex, True) for channelIndex in acquisitionIndices]
+
+        return stimulusChannels, acquisitionChannels
+
+    def _getSweepBytes(self, abfFile):
+        """
+        Returns the number of bytes of the largest block of sweep data of an ABF file held in memory at once, when
+        its sweeps are streamed.
+
+        ADC samples are read in chunks of STREAMING_CHUNK_SAMPLES, and each command waveform is generated whole.
+        The stacked layout reads a whole sweep per row.
+        """
+
+        stimulusChannels, acquisitionChannels = self._getSweepChannels(abfFile)
+        sampleCount = abfFile.sweepPointCount
+
+        if self.layout == "stacked":
+            adcSamples = sampleCount
+        else:
+            adcSamples = min(sampleCount, STREAMING_CHUNK_SAMPLES)
+
+        blockBytes = []
+
+        for channelIndex, isADC in stimulusChannels + acquisitionChannels:
+            if not isADC:
+                blockBytes += [sampleCount * 8]
+            elif self._storesRawData(abfFile, channelIndex, isADC):
+                blockBytes += [adcSamples * 2]
+            else:
+                blockBytes += [adcSamples * 4]
+
+        return max(blockBytes, default=0)
+
+    def _checkMemoryBudget(self):
+        """
+        Checks that the largest block of sweep data held at once fits into the memory budget, before anything is
+        converted.
+        """
+
+        for fileName, abfFile in zip(self.fileNames, self.abfFiles):
+            sweepBytes = self._getSweepBytes(abfFile)
+
+            if sweepBytes > self.maxMemory:
+                raise ValueError(f"Converting {fileName} holds {sweepBytes} bytes of sweep data at once, "
+                                 f"more than the memory budget of {self.maxMemory} bytes.")
+
+    def _getCompressionSettings(self):
+        """
+        Resolves the compression profile to the H5DataIO arguments used for every dataset.
+
+        The "auto" profile is tuned on the first sweeps of the first file, as they will be stored.
+        """
+
+        if self.compression != "auto":
+            self.compressionSettings = COMPRESSION_PROFILES[self.compression]
+            return self.compressionSettings
+
+        abfFile = self.abfFiles[0]
+        reader = self._getReader(abfFile)
+        isRaw = self._storesRawData(abfFile, 0, isADC=True)
+
+        samples = []
+        for i in range(min(abfFile.sweepCount, 3)):
+            if isRaw:
+                samples.append(np.ascontiguousarray(reader.rawSweep(i, 0)))
+            else:
+                samples.append(reader.sweep(i, 0))
+
+        self.compressionSettings = autoTuneCompression(samples, self.compressionTimeBudget)
+
+        return self.compressionSettings
+
+    def _getDatasetSettings(self, data, rate):
+        """
+        Returns the compression settings of a dataset sampled at the given rate, with the chunk shape of the read
+        pattern if one is declared.
+
+        Uncompressed profiles are stored contiguously, which suits every read pattern.
+        """
+
+        if self.readPattern is None or "chunks" not in self.compressionSettings:
+            return self.compressionSettings
+
+        if isinstance(data, AbstractDataChunkIterator):
+            shape = data.maxshape
+        else:
+            shape = np.shape(data)
+
+        settings = dict(self.compressionSettings)
+        settings["chunks"] = getReadPatternChunks(self.readPattern, shape, data.dtype, rate, self.readWindow)
+
+        return settings
+
+    def _getNotes(self):
+        """
+        Returns the notes of the NWB file, which record the declared read pattern of the chunk shapes as JSON.
+        """
+
+        if self.readPattern is None:
+            return ""
+
+        return json.dumps({"chunk_layout": {"read_pattern": self.readPattern,
+                                            "read_window": self.readWindow,
+                                            "max_chunk_bytes": MAX_CHUNK_BYTES}}, sort_keys=True)
+
+    def _compressData(self, data, path, rate):
+        """
+        Returns the data of the dataset at the given path in the NWB file wrapped with the compression settings.
+
+        With several compression threads, in-memory arrays and sweeps read at write time are replaced by a
+        placeholder which only creates the dataset, and are queued for _writeDirectChunks.
+        """
+
+        compressionSettings = self._getDatasetSettings(data, rate)
+
+        if self.backend == "zarr":
+            return createZarrDataset(data, compressionSettings)
+
+        if (self.compressionThreads == 1 or not isinstance(data, (np.ndarray, SweepDataChunkIterator))
+                or not supportsDirectChunks(compressionSettings)):
+            return createCompressedDataset(data, compressionSettings)
 
-    Parameters
-    ----------
-    inputPath: path to ABF file or a folder of ABF files to be converted
-    outputFilePath: path to the output NWB file
-    gain: user-input value
-    acquisitionChannelName: Allows to output only a specific acquisition channel, defaults to all
-    stimulusChannelName: Allows to output only a specific stimulus channel,
-                         defaults to all. The name can also be an AD channel name for cases where
-                         the stimulus is recorded as well.
-    """
+        shape = data.maxshape if isinstance(data, SweepDataChunkIterator) else data.shape
+        chunkShape = getChunkShape(compressionSettings, shape, data.dtype)
 
-    def __init__(self, inputPath, outputFilePath, gain=None, acquisitionChannelName=None, stimulusChannelName=None):
+        settings = dict(compressionSettings)
+        settings["compression"] = "gzip"
+        settings["compression_opts"] = settings.get("compression_opts") or 4
+        settings["chunks"] = chunkShape
 
-        self.inputPath = inputPath
-        self.debug=False
+        self._directChunks += [(path, data, settings)]
 
-        if os.path.isfile(self.inputPath):
-            print(inputPath)
+        return H5DataIO(data=DirectChunkPlaceholder(shape, data.dtype, chunkShape), **settings)
 
-            abf = pyabf.ABF(self.inputPath)
-            if abf.abfVersion["major"] != 1:
-                raise ValueError(f"The ABF version for the file {abf} is not supported.")
+    def _createIO(self, mode):
+        """
+        Returns the writer of the output file for the backend.
+        """
 
-            self.fileNames = [os.path.basename(self.inputPath)]
-            self.abfFiles = [abf]
+        if self.backend == "zarr":
+            return NWBZarrIO(self.outputPath, mode)
 
-        elif os.path.isdir(self.inputPath):
-            abfFiles = []
-            for dirpath, dirnames, filenames in os.walk(self.inputPath):
+        return NWBHDF5IO(self.outputPath, mode)
 
-                # Find all .abf files in the directory
-                if len(dirnames) == 0 and len(glob.glob(dirpath + "/*.abf")) != 0:
-                    abfFiles += glob.glob(dirpath + "/*.abf")
+    def _iterateDirectChunks(self, f):
+        """
+        Yields the dataset in the open output file, the offset, the data and the settings of every chunk of the
+        queued datasets, one dataset after the other.
+        """
 
-            if len(abfFiles) == 0:
-                raise ValueError(f"{inputPath} contains no ABF Files.")
+        for path, data, settings in self._directChunks:
+            dataset = f[path]
 
-            # Arrange the ABF files in ascending order
-            abfFiles.sort(key=lambda x: os.path.basename(x))
+            for offset, chunk in iterateChunks(data, settings["chunks"]):
+                yield dataset, offset, chunk, settings
 
-            # Collect file names for description
-            self.fileNames = []
-            for file in abfFiles:
-                self.fileNames += [os.path.basename(file)]
+    def _writeDirectChunks(self):
+        """
+        Compresses the chunks of the queued datasets in a thread pool and writes them to the closed output file
+        with direct chunk writes, which bypass the HDF5 filter pipeline.
 
-            self.abfFiles = []
-            for abfFile in abfFiles:
-                # Load each ABF file using pyabf
-                abf = pyabf.ABF(abfFile)
+        The chunks of all datasets are fed to the pool as a single stream, which only holds twice as many chunks as
+        there are threads. Chunks are written in order, each as soon as it and the ones before it are compressed.
+        The stored chunks are identical to the ones HDF5 would write, so the file reads as usual.
+        """
 
-                # Check for ABF version
-                if abf.abfVersion["major"] != 1:
-                    raise ValueError(f"The ABF version for the file {abf} is not supported.")
+        if not self._directChunks:
+            return
 
-                self.abfFiles += [abf]
+        with h5py.File(self.outputPath, "r+") as f, ThreadPoolExecutor(self.compressionThreads) as executor:
+            pending = deque()
 
-        self.outputPath = outputFilePath
+            for dataset, offset, chunk, settings in self._iterateDirectChunks(f):
+                pending.append((dataset, offset, executor.submit(compressChunk, chunk, settings)))
 
-        # Take metadata input, and return hard coded values for None
+                if len(pending) >= 2 * self.compressionThreads:
+                    dataset, offset, future = pending.popleft()
+                    dataset.id.write_direct_chunk(offset, future.result())
 
-        if gain:
-            self.gain = gain
-        else:
-            self.gain = 1.0
+            for dataset, offset, future in pending:
+                dataset.id.write_direct_chunk(offset, future.result())
 
-        self.acquisitionChannelName = acquisitionChannelName
-        self.stimulusChannelName    = stimulusChannelName
+        self._directChunks = []
+        self._dacWaveform = None
 
     def _outputMetadata(self):
         """
@@ -109,6 +1174,68 @@ class ABF1Converter:
 
         return abf.tagComments
 
+    def _getSweepsModule(self):
+        """
+        Returns the "sweeps" processing module, creating it on first use.
+        """
+
+        if "sweeps" not in self.NWBFile.processing:
+            self.NWBFile.create_processing_module(name="sweeps", description="Sweep data and metadata of the cell")
+
+        return self.NWBFile.processing["sweeps"]
+
+    def _addSweepMetadata(self):
+
+        """
+        Adds the "metadata" table to the "sweeps" processing module, with one row per sweep of every ABF file.
+
+        The row of a sweep is referenced as "sweep_metadata_row" from the descriptions of its series.
+        """
+
+        table = DynamicTable(name="metadata", description="File and protocol metadata of each sweep")
+        table.add_column(name="file_index", description="Index of the ABF file in the cell")
+        table.add_column(name="file_name", description="Name of the ABF file")
+        table.add_column(name="file_version", description="ABF version of the file")
+        table.add_column(name="sweep_number", description="Sweep number within the ABF file")
+        table.add_column(name="protocol", description="Name of the protocol")
+        table.add_column(name="protocol_path", description="Path of the protocol file")
+        table.add_column(name="comments", description="Tag comments created in Clampfit, as a JSON list")
+
+        row = 0
+        for idx, abfFile in enumerate(self.abfFiles):
+            for i in range(abfFile.sweepCount):
+                table.add_row(file_index=idx,
+                              file_name=os.path.basename(self.fileNames[idx]),
+                              file_version=abfFile.abfVersionString,
+                              sweep_number=i,
+                              protocol=abfFile.protocol,
+                              protocol_path=abfFile.protocolPath,
+                              comments=json.dumps(self._getComments(abfFile)))
+
+                self._descriptions[(idx, i)] = json.dumps({"sweep_metadata_row": row})
+                row += 1
+
+        self._getSweepsModule().add_data_interface(table)
+
+    def _getDescription(self, idx, abfFile, sweepNumber):
+
+        """
+        Returns the JSON description of the series of a sweep, built once per sweep.
+        """
+
+        key = (idx, sweepNumber)
+
+        if key not in self._descriptions:
+            self._descriptions[key] = json.dumps({"file_name": os.path.basename(abfFile.abfFilePath),
+                                                  "file_version": abfFile.abfVersionString,
+                                                  "sweep_number": sweepNumber,
+                                                  "protocol": abfFile.protocol,
+                                                  "protocol_path": abfFile.protocolPath,
+                                                  "comments": self._getComments(abfFile)},
+                                                 sort_keys=True, indent=4)
+
+        return self._descriptions[key]
+
     def _createNWBFile(self):
 
         """
@@ -124,7 +1251,7 @@ class ABF1Converter:
             identifier=self.inputCellName,
             file_create_date= datetime.now(tzlocal()),
             experimenter=None,
-            notes=""
+            notes=self._getNotes()
         )
         return self.NWBFile
 
@@ -168,185 +1295,546 @@ class ABF1Converter:
 
         return self.clampMode
 
-    def _addStimulus(self):
+    def _createStimulusSeries(self, idx, abfFile, sweepNumber, channelIndex, data, scaledUnit, isADC):
 
         """
-        Adds a stimulus class as defined by PyNWB to the NWB File.
+        Returns the stimulus series of one channel of a sweep, as defined by PyNWB.
+        """
+
+        seriesName = f"Index_{idx}_{sweepNumber}_{channelIndex}"
+
+        scaling, unit = self._getScaling(abfFile, channelIndex, scaledUnit, isADC=isADC)
+        electrode = self.electrode
+        gain = 1.0  # hard coded for White Noise data
+        resolution = np.nan
+        starting_time = 0.0
+        rate = float(abfFile.dataRate)
+
+        # Create a JSON file for the description field
+        description = self._getDescription(idx, abfFile, sweepNumber)
+
+        # Determine the clamp mode
+        if self.clampMode == 0:
+            stimulusClass = VoltageClampStimulusSeries
+        elif self.clampMode == 1:
+            stimulusClass = CurrentClampStimulusSeries
+        else:
+            raise ValueError(f"Unsupported clamp mode {self.clampMode}")
+
+        data = self._compressData(data, f"/stimulus/presentation/{seriesName}/data", rate)
+
+        # Create a stimulus class
+        return stimulusClass(name=seriesName,
+                             data=data,
+                             sweep_number=sweepNumber,
+                             electrode=electrode,
+                             gain=gain,
+                             resolution=resolution,
+                             starting_time=starting_time,
+                             rate=rate,
+                             unit=unit,
+                             description=description,
+                             **scaling
+                             )
+
+    def _createAcquisitionSeries(self, idx, abfFile, sweepNumber, channelIndex, data, scaledUnit):
 
-        Written for experiments conducted from a single channel.
-        For multiple channels, refer to https://github.com/AllenInstitute/ipfx/blob/master/ipfx/x_to_nwb/ABFConverter.py
+        """
+        Returns the acquisition series of one channel of a sweep, as defined by PyNWB.
         """
 
-        for idx, abfFile in enumerate(self.abfFiles):
+        seriesName = f"Index_{idx}_{sweepNumber}_{channelIndex}"
+        scaling, unit = self._getScaling(abfFile, channelIndex, scaledUnit, isADC=True)
+        electrode = self.electrode
+        gain = 1.0  # hard coded for White Noise data
+        resolution = np.nan
+        starting_time = 0.0
+        rate = float(abfFile.dataRate)
 
-            isStimulus = True
+        # Create a JSON file for the description field
+        description = self._getDescription(idx, abfFile, sweepNumber)
 
-            if self.stimulusChannelName is None:
-                channelList = abfFile.adcNames
-                channelIndices = range(len(channelList))
-            else:
-                if self.stimulusChannelName in abfFile.dacNames:
-                    channelList = abfFile.dacNames
-                    channelIndices = [channelList.index(self.stimulusChannelName)]
-                elif self.stimulusChannelName in abfFile.adcNames:
-                    isStimulus = False
-                    channelList = abfFile.adcNames
-                    channelIndices = [channelList.index(self.stimulusChannelName)]
-                else:
-                    raise ValueError(f"Channel {self.stimulusChannelName} could not be found.")
+        # Create an acquisition class
+        # Note: voltage input produces current output; current input produces voltage output
 
-            for i in range(abfFile.sweepCount):
-                for channelIndex in channelIndices:
+        data = self._compressData(data, f"/acquisition/{seriesName}/data", rate)
 
-                    if self.debug:
-                        print(f"stimulus: abfFile={abfFile.abfFilePath}, sweep={i}, channelIndex={channelIndex}, channelName={channelList[channelIndex]}")
-
-                    # Collect data from pyABF
-                    abfFile.setSweep(i, channel=channelIndex)
-                    seriesName = f"Index_{idx}_{i}_{channelIndex}"
-
-                    if isStimulus:
-                        data = abfFile.sweepC
-                        scaledUnit = abfFile.sweepUnitsC
-                    else:
-                        data = abfFile.sweepY
-                        scaledUnit = abfFile.sweepUnitsY
-
-                    conversion, unit = self._unitConversion(scaledUnit)
-                    electrode = self.electrode
-                    gain = 1.0  # hard coded for White Noise data
-                    resolution = np.nan
-                    starting_time = 0.0
-                    rate = float(abfFile.dataRate)
-
-                    # Create a JSON file for the description field
-                    description = json.dumps({"file_name": os.path.basename(self.fileNames[idx]),
-                                              "file_version": abfFile.abfVersionString,
-                                              "sweep_number": i,
-                                              "protocol": abfFile.protocol,
-                                              "protocol_path": abfFile.protocolPath,
-                                              "comments": self._getComments(abfFile)},
-                                             sort_keys=True, indent=4)
-
-                    # Determine the clamp mode
-                    if self.clampMode == 0:
-                        stimulusClass = VoltageClampStimulusSeries
-                    elif self.clampMode == 1:
-                        stimulusClass = CurrentClampStimulusSeries
-                    else:
-                        raise ValueError(f"Unsupported clamp mode {self.clampMode}")
-
-                    data = createCompressedDataset(data)
-
-                    # Create a stimulus class
-                    stimulus = stimulusClass(name=seriesName,
+        if self.clampMode == 0:
+            acquisition = CurrentClampSeries(name=seriesName,
                                              data=data,
-                                             sweep_number=i,
+                                             sweep_number=sweepNumber,
                                              electrode=electrode,
                                              gain=gain,
                                              resolution=resolution,
-                                             conversion=conversion,
                                              starting_time=starting_time,
                                              rate=rate,
                                              unit=unit,
-                                             description=description
+                                             description=description,
+                                             bias_current=np.nan,
+                                             bridge_balance=np.nan,
+                                             capacitance_compensation=np.nan,
+                                             **scaling
                                              )
 
-                    self.NWBFile.add_stimulus(stimulus)
+        elif self.clampMode == 1:
+            acquisition = VoltageClampSeries(name=seriesName,
+                                             data=data,
+                                             sweep_number=sweepNumber,
+                                             electrode=electrode,
+                                             gain=gain,
+                                             resolution=resolution,
+                                             starting_time=starting_time,
+                                             rate=rate,
+                                             unit=unit,
+                                             description=description,
+                                             capacitance_fast=np.nan,
+                                             capacitance_slow=np.nan,
+                                             resistance_comp_bandwidth=np.nan,
+                                             resistance_comp_correction=np.nan,
+                                             resistance_comp_prediction=np.nan,
+                                             whole_cell_capacitance_comp=np.nan,
+                                             whole_cell_series_resistance_comp=np.nan,
+                                             **scaling
+                                             )
+        else:
+            raise ValueError(f"Unsupported clamp mode {self.clampMode}")
+
+        return acquisition
 
-    def _addAcquisition(self):
+    def _addSweeps(self):
 
         """
-        Adds an acquisition class as defined by PyNWB to the NWB File.
+        Adds the stimulus and acquisition classes as defined by PyNWB to the NWB File.
+
+        Each sweep is decoded once, and its channels are routed to both the stimulus and the acquisition series.
+        The acquisition series are added after all stimulus series, in the same order as when adding them separately.
 
         Written for experiments conducted from a single channel.
         For multiple channels, refer to https://github.com/AllenInstitute/ipfx/blob/master/ipfx/x_to_nwb/ABFConverter.py
         """
 
-        for idx, abfFile in enumerate(self.abfFiles):
+        acquisitions = []
 
-            if self.acquisitionChannelName is None:
-                channelList = abfFile.adcNames
-                channelIndices = range(len(channelList))
-            else:
-                if self.acquisitionChannelName in abfFile.adcNames:
-                    channelList = abfFile.adcNames
-                    channelIndices = [channelList.index(self.acquisitionChannelName)]
-                else:
-                    raise ValueError(f"Channel {self.acquisitionChannelName} could not be found.")
+        for idx, abfFile in enumerate(self.abfFiles, self.firstFileIndex):
+
+            stimulusList, _, _ = self._getStimulusChannels(abfFile)
+            acquisitionList, _ = self._getAcquisitionChannels(abfFile)
+            stimulusChannels, acquisitionChannels = self._getSweepChannels(abfFile)
 
             for i in range(abfFile.sweepCount):
-                for channelIndex in channelIndices:
+
+                sweep = self._decodeSweep(abfFile, i, stimulusChannels + acquisitionChannels)
+
+                for channelIndex, isADC in stimulusChannels:
+
+                    if self.debug:
+                        print(f"stimulus: abfFile={abfFile.abfFilePath}, sweep={i}, channelIndex={channelIndex}, channelName={stimulusList[channelIndex]}")
+
+                    data, scaledUnit = self._takeSweepData(sweep, (channelIndex, isADC))
+                    stimulus = self._createStimulusSeries(idx, abfFile, i, channelIndex, data, scaledUnit, isADC)
+                    self.NWBFile.add_stimulus(stimulus)
+
+                for channelIndex, isADC in acquisitionChannels:
 
                     if self.debug:
-                        print(f"acquisition: abfFile={abfFile.abfFilePath}, sweep={i}, channelIndex={channelIndex}, channelName={channelList[channelIndex]}")
-
-                    # Collect data from pyABF
-                    abfFile.setSweep(i, channel=channelIndex)
-                    seriesName = f"Index_{idx}_{i}_{channelIndex}"
-                    data = abfFile.sweepY
-                    conversion, unit = self._unitConversion(abfFile.sweepUnitsY)
-                    electrode = self.electrode
-                    gain = 1.0  # hard coded for White Noise data
-                    resolution = np.nan
-                    starting_time = 0.0
-                    rate = float(abfFile.dataRate)
-
-                    # Create a JSON file for the description field
-                    description = json.dumps({"file_name": os.path.basename(self.fileNames[idx]),
-                                              "file_version": abfFile.abfVersionString,
-                                              "sweep_number": i,
-                                              "protocol": abfFile.protocol,
-                                              "protocol_path": abfFile.protocolPath,
-                                              "comments": self._getComments(abfFile)},
-                                             sort_keys=True, indent=4)
-
-                    # Create an acquisition class
-                    # Note: voltage input produces current output; current input produces voltage output
-
-                    data = createCompressedDataset(data)
-
-                    if self.clampMode == 0:
-                        acquisition = CurrentClampSeries(name=seriesName,
-                                                         data=data,
-                                                         sweep_number=i,
-                                                         electrode=electrode,
-                                                         gain=gain,
-                                                         resolution=resolution,
-                                                         conversion=conversion,
-                                                         starting_time=starting_time,
-                                                         rate=rate,
-                                                         unit=unit,
-                                                         description=description,
-                                                         bias_current=np.nan,
-                                                         bridge_balance=np.nan,
-                                                         capacitance_compensation=np.nan,
-                                                         )
-
-                    elif self.clampMode == 1:
-                        acquisition = VoltageClampSeries(name=seriesName,
-                                                         data=data,
-                                                         sweep_number=i,
-                                                         electrode=electrode,
-                                                         gain=gain,
-                                                         resolution=resolution,
-                                                         conversion=conversion,
-                                                         starting_time=starting_time,
-                                                         rate=rate,
-                                                         unit=unit,
-                                                         description=description,
-                                                         capacitance_fast=np.nan,
-                                                         capacitance_slow=np.nan,
-                                                         resistance_comp_bandwidth=np.nan,
-                                                         resistance_comp_correction=np.nan,
-                                                         resistance_comp_prediction=np.nan,
-                                                         whole_cell_capacitance_comp=np.nan,
-                                                         whole_cell_series_resistance_comp=np.nan
-                                                         )
-                    else:
-                        raise ValueError(f"Unsupported clamp mode {self.clampMode}")
+                        print(f"acquisition: abfFile={abfFile.abfFilePath}, sweep={i}, channelIndex={channelIndex}, channelName={acquisitionList[channelIndex]}")
+
+                    data, scaledUnit = self._takeSweepData(sweep, (channelIndex, isADC))
+                    acquisitions.append(self._createAcquisitionSeries(idx, abfFile, i, channelIndex, data, scaledUnit))
+
+        for acquisition in acquisitions:
+            self.NWBFile.add_acquisition(acquisition)
+
+    def _writeBatch(self):
+
+        """
+        Writes the series added since the output file was opened for appending, and closes it.
+        """
+
+        self._batchIO.write(self.NWBFile)
+        self._batchIO.close()
+        self._batchIO = None
+
+        self._writeDirectChunks()
+
+    def _stackSweeps(self, rows, sampleCount):
+        """
+        Returns the sweeps given as (file index, sweep number, channel index, isADC) rows as one 2-D array,
+        or as an iterator over the rows in streaming mode.
+        """
+
+        if self.streaming:
+            sweeps = (self._readSweep(self.abfFiles[idx], i, channelIndex, isADC)
+                      for idx, i, channelIndex, isADC in rows)
+            return DataChunkIterator(data=sweeps, maxshape=(len(rows), sampleCount))
+
+        data = None
+
+        for row, (idx, i, channelIndex, isADC) in enumerate(rows):
+            sweep = self._readSweep(self.abfFiles[idx], i, channelIndex, isADC)
+
+            if data is None:
+                data = np.empty((len(rows), sampleCount), dtype=sweep.dtype)
+            data[row] = sweep
+
+        self._unloadSweepData()
+
+        return data
+
+    def _addStackedSweeps(self):
+
+        """
+        Adds the stimulus and acquisition of every channel as rows of a single (sweeps x samples) dataset.
+
+        Sweeps of a channel sharing length, rate, unit and scaling go into the "data" column of one table in the
+        "sweeps" processing module. The other columns index each row by file and sweep number, and the
+        attributes shared by all rows are stored as JSON in the table description.
+        """
+
+        if self.clampMode == 0:
+            stimulusType, acquisitionType = "VoltageClampStimulusSeries", "CurrentClampSeries"
+        elif self.clampMode == 1:
+            stimulusType, acquisitionType = "CurrentClampStimulusSeries", "VoltageClampSeries"
+        else:
+            raise ValueError(f"Unsupported clamp mode {self.clampMode}")
+
+        groups = {}
+
+        for idx, abfFile in enumerate(self.abfFiles):
+
+            _, stimulusChannels, isStimulus = self._getStimulusChannels(abfFile)
+            _, acquisitionChannels = self._getAcquisitionChannels(abfFile)
+
+            channels = [("Stimulus", stimulusType, channelIndex, not isStimulus) for channelIndex in stimulusChannels]
+            channels += [("Acquisition", acquisitionType, channelIndex, True) for channelIndex in acquisitionChannels]
+
+            for kind, seriesType, channelIndex, isADC in channels:
+
+                if isADC:
+                    scaledUnit = abfFile._getAdcNameAndUnits(channelIndex)[1]
+                else:
+                    scaledUnit = abfFile._getDacNameAndUnits(channelIndex)[1]
+
+                scaling, unit = self._getScaling(abfFile, channelIndex, scaledUnit, isADC)
+
+                attributes = {"neurodata_type": seriesType,
+                              "unit": unit,
+                              "gain": 1.0,  # hard coded for White Noise data
+                              "starting_time": 0.0,
+                              "rate": float(abfFile.dataRate)}
+                attributes.update(scaling)
+
+                key = (kind, channelIndex, abfFile.sweepPointCount, json.dumps(attributes, sort_keys=True))
+                groups.setdefault(key, [])
+                groups[key] += [(idx, i, channelIndex, isADC) for i in range(abfFile.sweepCount)]
+
+        module = self._getSweepsModule()
+
+        tableNames = []
+
+        for (kind, channelIndex, sampleCount, description), rows in groups.items():
+
+            tableName = f"{kind}_{channelIndex}"
+            if tableName in tableNames:
+                tableName += f"_{tableNames.count(tableName)}"
+            tableNames += [f"{kind}_{channelIndex}"]
+
+            rate = float(self.abfFiles[rows[0][0]].dataRate)
+            data = self._compressData(self._stackSweeps(rows, sampleCount), f"/processing/sweeps/{tableName}/data",
+                                      rate)
+
+            columns = [VectorData(name="file_index", description="Index of the ABF file in the cell",
+                                  data=[idx for idx, _, _, _ in rows]),
+                       VectorData(name="file_name", description="Name of the ABF file",
+                                  data=[self.fileNames[idx] for idx, _, _, _ in rows]),
+                       VectorData(name="sweep_number", description="Sweep number within the ABF file",
+                                  data=[i for _, i, _, _ in rows]),
+                       VectorData(name="data", description="Samples of the sweep", data=data)]
+
+            table = DynamicTable(name=tableName, description=description, id=list(range(len(rows))), columns=columns)
+            module.add_data_interface(table)
+
+    def _sweepCount(self):
+        return sum([abfFile.sweepCount for abfFile in self.abfFiles])
+
+    def _sweepDataBytes(self):
+        """
+        Returns the size of the int16 sweep data of all ABF files, as stored in the files.
+        """
+
+        return sum([abfFile.sweepCount * abfFile.sweepPointCount * abfFile.channelCount * 2
+                    for abfFile in self.abfFiles])
+
+    @contextmanager
+    def _profileStage(self, name, bytesIn=0, sweepCount=0):
+        """
+        Records the wall time, bytes read, sweep throughput and peak memory of a conversion stage into
+        profileReport when profiling.
+
+        Yields the record of the stage, so that the bytes written can be added once known.
+        The peak memory is the high-water mark of the process at the end of the stage, a stage which raised it
+        shows a higher value than the previous one.
+        """
+
+        if not self.profile:
+            yield {}
+            return
+
+        stage = {"stage": name, "bytes_in": bytesIn, "bytes_out": 0, "sweeps": sweepCount}
+        startTime = time.perf_counter()
+
+        yield stage
+
+        stage["seconds"] = time.perf_counter() - startTime
+        stage["sweeps_per_second"] = sweepCount / stage["seconds"] if stage["seconds"] > 0 else 0.0
+        stage["peak_memory"] = peakMemory()
 
+        self.profileReport["stages"].append(stage)
+
+    def _getStoredBytes(self, abfFile):
+        """
+        Returns the number of bytes of sweep data stored uncompressed per sweep of an ABF file, and the number of
+        series per sweep.
+        """
+
+        stimulusChannels, acquisitionChannels = self._getSweepChannels(abfFile)
+        storedBytes = 0
+
+        for channelIndex, isADC in stimulusChannels + acquisitionChannels:
+            if not isADC:
+                itemSize = 8
+            elif self._storesRawData(abfFile, channelIndex, isADC):
+                itemSize = 2
+            else:
+                itemSize = 4
+
+            storedBytes += abfFile.sweepPointCount * itemSize
+
+        return storedBytes, len(stimulusChannels) + len(acquisitionChannels)
+
+    def _trialConversion(self, compression, sweepCount):
+        """
+        Converts the first sweeps of the first ABF file with a compression profile into an NWB file held in memory.
+
+        Returns the wall time, the size of the file, the number of series and the bytes of sweep data before and
+        after compression.
+        """
+
+        abfFile = self.abfFiles[0]
+        stimulusChannels, acquisitionChannels = self._getSweepChannels(abfFile)
+
+        # The trial data is compressed by HDF5, as direct chunk writes would go to the output file, so the
+        # estimates of the zarr backend are those of HDF5
+        compressionThreads = self.compressionThreads
+        backend = self.backend
+        self.compressionThreads = 1
+        self.backend = "hdf5"
+        self.compressionSettings = COMPRESSION_PROFILES[compression]
+
+        startTime = time.perf_counter()
+
+        try:
+            self._createNWBFile()
+            self._createDevice()
+            self._createElectrode()
+            self._getClampMode()
+
+            series = []
+            for i in range(sweepCount):
+                sweep = self._decodeSweep(abfFile, i, stimulusChannels + acquisitionChannels)
+
+                for channelIndex, isADC in stimulusChannels:
+                    data, scaledUnit = self._takeSweepData(sweep, (channelIndex, isADC))
+                    stimulus = self._createStimulusSeries(0, abfFile, i, channelIndex, data, scaledUnit, isADC)
+                    self.NWBFile.add_stimulus(stimulus)
+                    series += [f"/stimulus/presentation/{stimulus.name}/data"]
+
+                for channelIndex, isADC in acquisitionChannels:
+                    data, scaledUnit = self._takeSweepData(sweep, (channelIndex, isADC))
+                    acquisition = self._createAcquisitionSeries(0, abfFile, i, channelIndex, data, scaledUnit)
                     self.NWBFile.add_acquisition(acquisition)
+                    series += [f"/acquisition/{acquisition.name}/data"]
+
+            with h5py.File("trialConversion", "w", driver="core", backing_store=False, block_size=512) as f:
+                # Measured before the file is closed along with the NWB writer
+                with NWBHDF5IO(mode="w", file=f) as io:
+                    io.write(self.NWBFile, cache_spec=True)
+
+                    f.flush()
+                    fileBytes = f.id.get_filesize()
+                    dataBytes = sum([f[path].size * f[path].dtype.itemsize for path in series])
+                    storedBytes = sum([f[path].id.get_storage_size() for path in series])
+        finally:
+            self._unloadSweepData()
+            self.compressionThreads = compressionThreads
+            self.backend = backend
+
+        return time.perf_counter() - startTime, fileBytes, len(series), dataBytes, storedBytes
+
+    def _calibrate(self):
+        """
+        Measures the file overhead and, per compression profile, the compression ratio and the size and time
+        taken per series and per byte of sweep data, from trial conversions of the first sweeps in memory.
+        """
+
+        sweepCount = min(self.abfFiles[0].sweepCount, CALIBRATION_SWEEPS)
+        fileSeconds, fileBytes, _, _, _ = self._trialConversion("none", 0)
+
+        calibration = {"file_bytes": fileBytes, "file_seconds": fileSeconds, "profiles": {}}
+
+        for compression in COMPRESSION_PROFILES:
+            seconds, trialBytes, seriesCount, dataBytes, storedBytes = self._trialConversion(compression, sweepCount)
+
+            # The time spent on the sweep data is that of the trial minus the one of the empty file, split into
+            # a part per series and a part per byte as the share of the data in the stored bytes
+            seriesBytes = max(trialBytes - fileBytes - storedBytes, 0) / max(seriesCount, 1)
+            dataShare = storedBytes / max(trialBytes - fileBytes, 1)
+            sweepSeconds = max(seconds - fileSeconds, 0)
+
+            calibration["profiles"][compression] = {
+                "ratio": storedBytes / max(dataBytes, 1),
+                "series_bytes": seriesBytes,
+                "seconds_per_series": sweepSeconds * (1 - dataShare) / max(seriesCount, 1),
+                "seconds_per_byte": sweepSeconds * dataShare / max(dataBytes, 1)}
+
+        return calibration
+
+    def planConversion(self, calibration=None):
+
+        """
+        Estimates the size and conversion time of the output file for every compression profile, without writing.
+
+        The work is sized from the headers of the ABF files, and priced with a calibration from _calibrate, which
+        is measured on the first file when not given, so that one calibration can be reused for many cells.
+        When appending, only the ABF files not yet in the output file are planned, and the estimates are the bytes
+        and time they add to it.
+        Returns the plan as a dict, including its calibration.
+        """
+
+        abfFiles = list(zip(self.fileNames, self.abfFiles))
+        appending = self.append and os.path.exists(self.outputPath)
+
+        if appending:
+            with NWBHDF5IO(self.outputPath, "r") as io:
+                self.NWBFile = io.read()
+                convertedFiles, _ = self._getConvertedFiles()
+
+            abfFiles = [(fileName, abfFile) for fileName, abfFile in abfFiles if fileName not in convertedFiles]
+
+        if calibration is None:
+            calibration = self._calibrate()
+
+        sweepCount = 0
+        seriesCount = 0
+        dataBytes = 0
+        stackedTables = set()
+
+        for _, abfFile in abfFiles:
+            storedBytes, sweepSeries = self._getStoredBytes(abfFile)
+            stimulusChannels, acquisitionChannels = self._getSweepChannels(abfFile)
+
+            sweepCount += abfFile.sweepCount
+            seriesCount += abfFile.sweepCount * sweepSeries
+            dataBytes += abfFile.sweepCount * storedBytes
+
+            stackedTables.update([("stimulus", channel, abfFile.sweepPointCount) for channel in stimulusChannels])
+            stackedTables.update([("acquisition", channel, abfFile.sweepPointCount) for channel in acquisitionChannels])
+
+        # Stacked sweeps are stored as one table per channel and sweep length instead of one series per sweep
+        datasetCount = len(stackedTables) if self.layout == "stacked" else seriesCount
+
+        estimates = {}
+        for compression, profile in calibration["profiles"].items():
+            outputBytes = dataBytes * profile["ratio"] + datasetCount * profile["series_bytes"]
+            seconds = dataBytes * profile["seconds_per_byte"] + datasetCount * profile["seconds_per_series"]
+
+            if abfFiles and not appending:
+                outputBytes += calibration["file_bytes"]
+                seconds += calibration["file_seconds"]
+
+            estimates[compression] = {"bytes": int(outputBytes), "seconds": seconds}
+
+        return {"input": self.inputPath,
+                "output": self.outputPath,
+                "files": [fileName for fileName, _ in abfFiles],
+                "sweeps": sweepCount,
+                "series": seriesCount,
+                "data_bytes": dataBytes,
+                "compression": self.compression,
+                "estimates": estimates,
+                "calibration": calibration}
+
+    def _getConvertedFiles(self):
+        """
+        Returns the names of the ABF files already stored in the NWB file and the next free file index.
+        """
+
+        if "sweeps" in self.NWBFile.processing:
+            raise ValueError(f"Appending to {self.outputPath} is not supported, it has a sweeps processing module.")
+
+        fileNames = set()
+        nextFileIndex = 0
+
+        for series in list(self.NWBFile.stimulus.values()) + list(self.NWBFile.acquisition.values()):
+            if not series.name.startswith("Index_"):
+                continue
+
+            fileNames.add(json.loads(series.description)["file_name"])
+            nextFileIndex = max(nextFileIndex, int(series.name.split("_")[1]) + 1)
+
+        return fileNames, nextFileIndex
+
+    def _appendToNWBFile(self):
+
+        """
+        Adds the sweeps of the ABF files which are not yet present to the existing output file.
+        """
+
+        # Kept open until the new series are written, as they are added to the file read from it
+        self._batchIO = NWBHDF5IO(self.outputPath, "a")
+
+        try:
+            with self._profileStage("read"):
+                self.NWBFile = self._batchIO.read()
+
+            convertedFiles, self.firstFileIndex = self._getConvertedFiles()
+            newFiles = [(fileName, abfFile) for fileName, abfFile in zip(self.fileNames, self.abfFiles)
+                        if fileName not in convertedFiles]
+
+            if len(newFiles) == 0:
+                print(f"{self.outputPath} already contains all ABF files.")
+                return
+
+            # The clamp mode is taken from the first file of the cell, as in a full conversion
+            self._getClampMode()
+
+            self.fileNames = [fileName for fileName, _ in newFiles]
+            self.abfFiles = [abfFile for _, abfFile in newFiles]
+
+            if self.maxMemory is not None:
+                self._checkMemoryBudget()
+
+            self.electrode = self.NWBFile.get_ic_electrode("elec0")
+
+            with self._profileStage("compression"):
+                self._getCompressionSettings()
+
+            with self._profileStage("addSweeps", self._sweepDataBytes(), self._sweepCount()):
+                self._addSweeps()
+
+            with self._profileStage("write", sweepCount=self._sweepCount()) as stage:
+                self._writeBatch()
+        finally:
+            if self._batchIO is not None:
+                self._batchIO.close()
+                self._batchIO = None
+
+        stage["bytes_out"] = os.path.getsize(self.outputPath)
+
+        self._closeReaders()
+        self._unloadSweepData()
+
+        print(f"Successfully appended {len(newFiles)} file(s) to {self.outputPath}.")
 
     def convert(self):
 
@@ -355,14 +1843,68 @@ class ABF1Converter:
         :return: True (for success)
         """
 
-        self._createNWBFile()
-        self._createDevice()
-        self._createElectrode()
-        self._getClampMode()
-        self._addStimulus()
-        self._addAcquisition()
+        if self.dryRun:
+            self.conversionPlan = self.planConversion()
+            self._closeReaders()
+
+            plan = self.conversionPlan
+            print(f"Planned {plan['output']}: {len(plan['files'])} file(s), {plan['sweeps']} sweeps, "
+                  f"{plan['series']} series, {plan['data_bytes'] / 1e6:.1f} MB of sweep data.")
+
+            for compression, estimate in plan["estimates"].items():
+                print(f"  {compression}: {estimate['bytes'] / 1e6:.1f} MB in {estimate['seconds']:.1f} s")
+
+            return
+
+        if self.profile:
+            self.profileReport = {"input": self.inputPath, "output": self.outputPath, "stages": []}
+
+        if self.append and os.path.exists(self.outputPath):
+            self._appendToNWBFile()
+        else:
+            self._writeNWBFile()
+
+        if self.profile:
+            self.profileReport["seconds"] = sum([stage["seconds"] for stage in self.profileReport["stages"]])
+
+    def _writeNWBFile(self):
+
+        """
+        Converts all ABF files into a new NWB file.
+        """
+
+        if self.maxMemory is not None:
+            self._checkMemoryBudget()
+
+        with self._profileStage("createNWBFile"):
+            self._createNWBFile()
+            self._createDevice()
+            self._createElectrode()
+            self._getClampMode()
+
+        with self._profileStage("compression"):
+            self._getCompressionSettings()
+
+        if self.sweepTable:
+            with self._profileStage("sweepMetadata"):
+                self._addSweepMetadata()
+
+        with self._profileStage("addSweeps", self._sweepDataBytes(), self._sweepCount()):
+            if self.layout == "stacked":
+                self._addStackedSweeps()
+            else:
+                self._addSweeps()
+
+        # In streaming mode the sweeps are read and decoded while writing
+        with self._profileStage("write", sweepCount=self._sweepCount()) as stage:
+            with self._createIO("w") as io:
+                io.write(self.NWBFile, cache_spec=True)
+
+            self._writeDirectChunks()
+
+        stage["bytes_out"] = getOutputSize(self.outputPath)
 
-        with NWBHDF5IO(self.outputPath, "w") as io:
-            io.write(self.NWBFile, cache_spec=True)
+        self._closeReaders()
+        self._unloadSweepData()
 
         print(f"Successfully converted to {self.outputPath}.")
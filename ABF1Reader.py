@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class ABF1Reader:
+
+    """
+    Memory-mapped reader for the sweep data of an ABF1 file.
+
+    The int16 data section is mapped with np.memmap using the offsets from the ABF1 header, so sweeps are
+    read from the page cache on access instead of being decoded into one large float array up front.
+    Raw sweeps are returned as zero-copy views, scaled sweeps are identical to pyabf's sweepY.
+
+    Parameters
+    ----------
+    abf: pyabf.ABF object of an ABF1 file, the sweep data does not need to be loaded
+    """
+
+    def __init__(self, abf):
+
+        header = abf._headerV1
+
+        if header.nDataFormat != 0:
+            raise ValueError(f"The data format {header.nDataFormat} of the file {abf.abfFilePath} is not supported.")
+
+        self.abfFilePath = abf.abfFilePath
+        self.channelCount = abf.channelCount
+        self.sweepCount = abf.sweepCount
+        self.sweepPointCount = abf.sweepPointCount
+
+        # Scaling from ADC counts to the channel units, as computed by pyabf from the header
+        self.gain = list(abf._dataGain)
+        self.offset = list(abf._dataOffset)
+
+        dataByteStart = header.lDataSectionPtr * 512 + header.nNumPointsIgnored
+
+        # Sweeps are stored one after the other, with the samples of all channels interleaved
+        self._data = np.memmap(self.abfFilePath, dtype=np.int16, mode="r", offset=dataByteStart,
+                               shape=(self.sweepCount, self.sweepPointCount, self.channelCount))
+
+    def rawSweep(self, sweepNumber, channel, start=0, stop=None):
+
+        """
+        Returns a read-only view of the int16 ADC counts of one channel of a sweep.
+        """
+
+        return self._data[sweepNumber, start:stop, channel]
+
+    def sweep(self, sweepNumber, channel, start=0, stop=None):
+
+        """
+        Returns the scaled float32 samples of one channel of a sweep.
+        """
+
+        data = self.rawSweep(sweepNumber, channel, start, stop).astype(np.float32)
+        np.multiply(data, self.gain[channel], out=data)
+        np.add(data, self.offset[channel], out=data)
+
+        return data
+
+    def sweepChannels(self, sweepNumber, channels, raw=False):
+
+        """
+        Returns the samples of several channels of a sweep by channel, reading the interleaved block only once.
+
+        Raw channels are contiguous int16 copies, scaled channels are identical to sweep().
+        """
+
+        block = np.array(self._data[sweepNumber])
+        samples = {}
+
+        for channel in channels:
+            if raw:
+                samples[channel] = np.ascontiguousarray(block[:, channel])
+            else:
+                data = block[:, channel].astype(np.float32)
+                np.multiply(data, self.gain[channel], out=data)
+                np.add(data, self.offset[channel], out=data)
+                samples[channel] = data
+
+        return samples
+
+    def close(self):
+
+        """
+        Releases the memory map.
+        """
+
+        self._data = None
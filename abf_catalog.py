@@ -0,0 +1,170 @@
+#!/bin/env python
+
+import os
+import sys
+import json
+import argparse
+
+import pyabf
+
+from batch_tools import save_json
+
+# Name of the catalog written to the root of the archive by default
+CATALOG_NAME = "abf_catalog.json"
+
+
+def read_entry(abfFilePath):
+    """
+    Returns the catalog entry of an ABF file, parsed from its header only.
+    """
+
+    abf = pyabf.ABF(abfFilePath, loadData=False)
+    stat = os.stat(abfFilePath)
+
+    if abf.abfVersion["major"] == 1:
+        clampMode = abf._headerV1.nExperimentType
+    else:
+        clampMode = None
+
+    return {"path": abfFilePath,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "version": abf.abfVersionString,
+            "date": abf.abfDateTime.isoformat(),
+            "sweep_count": abf.sweepCount,
+            "adc_names": abf.adcNames,
+            "dac_names": abf.dacNames,
+            "clamp_mode": clampMode,
+            "protocol": abf.protocol,
+            "protocol_path": abf.protocolPath,
+            "data_rate": abf.dataRate}
+
+
+def load_catalog(catalogPath):
+    """
+    Returns the entries of a catalog by path, or an empty catalog if it does not exist yet.
+    """
+
+    if not os.path.exists(catalogPath):
+        return {}
+
+    with open(catalogPath) as f:
+        return {entry["path"]: entry for entry in json.load(f)}
+
+
+def save_catalog(catalogPath, catalog):
+    """
+    Writes the catalog sorted by path, replacing the previous one only once it is complete.
+    """
+
+    save_json(catalogPath, [catalog[path] for path in sorted(catalog)], indent=4)
+
+
+def index_archive(archivePath, catalogPath=None):
+    """
+    Walks an archive once and writes a catalog of the headers of all ABF files in it.
+
+    Files which are already in the catalog with the same size and modification time are not opened again,
+    entries of files which no longer exist are dropped.
+    Returns the catalog by path, and the files which could not be read with their errors.
+    """
+
+    if not os.path.isdir(archivePath):
+        raise ValueError(f"The folder {archivePath} does not exist.")
+
+    if catalogPath is None:
+        catalogPath = os.path.join(archivePath, CATALOG_NAME)
+
+    previous = load_catalog(catalogPath)
+    catalog = {}
+    failures = {}
+
+    for dirpath, dirnames, filenames in os.walk(archivePath):
+        for fileName in filenames:
+            if not fileName.lower().endswith(".abf"):
+                continue
+
+            abfFilePath = os.path.join(dirpath, fileName)
+            entry = previous.get(abfFilePath)
+
+            try:
+                # Fails for dangling links and files removed during the walk
+                stat = os.stat(abfFilePath)
+
+                if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                    catalog[abfFilePath] = entry
+                    continue
+
+                catalog[abfFilePath] = read_entry(abfFilePath)
+            except Exception as e:
+                failures[abfFilePath] = e
+
+    save_catalog(catalogPath, catalog)
+
+    return catalog, failures
+
+
+def select(catalog, version=None, protocol=None, clampMode=None, channelName=None):
+    """
+    Returns the catalog entries matching all given criteria, sorted by path.
+
+    version matches the major ABF version, protocol the protocol name or path, and channelName any ADC or DAC
+    channel name.
+    """
+
+    entries = []
+
+    for path in sorted(catalog):
+        entry = catalog[path]
+
+        if version is not None and not entry["version"].startswith(f"{version}."):
+            continue
+
+        if protocol is not None and protocol not in (entry["protocol"], entry["protocol_path"]):
+            continue
+
+        if clampMode is not None and clampMode != entry["clamp_mode"]:
+            continue
+
+        if channelName is not None and channelName not in entry["adc_names"] + entry["dac_names"]:
+            continue
+
+        entries += [entry]
+
+    return entries
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Index the headers of the ABF files in an archive.")
+    parser.add_argument("--catalog", default=None,
+                        help=f"Path of the catalog, defaults to {CATALOG_NAME} in the archive folder.")
+    parser.add_argument("--version", type=int, default=None,
+                        help="List only files of the given major ABF version.")
+    parser.add_argument("--protocol", default=None,
+                        help="List only files recorded with the given protocol, by name or path.")
+    parser.add_argument("--clampMode", type=int, default=None,
+                        help="List only files with the given clamp mode (0: voltage clamp, 1: current clamp).")
+    parser.add_argument("--channelName", default=None,
+                        help="List only files with the given ADC or DAC channel.")
+    parser.add_argument("archive", help="Folder to index.")
+
+    args = parser.parse_args()
+
+    catalog, failures = index_archive(args.archive, args.catalog)
+
+    for entry in select(catalog, version=args.version, protocol=args.protocol, clampMode=args.clampMode,
+                        channelName=args.channelName):
+        print(f"{entry['path']}\t{entry['version']}\t{entry['date']}\t{entry['sweep_count']} sweeps\t"
+              f"{entry['protocol']}")
+
+    if failures:
+        print(f"{len(failures)} file(s) could not be read:")
+        for path, error in sorted(failures.items()):
+            print(f"  {path}: {error}")
+
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
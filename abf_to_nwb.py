@@ -3,12 +3,198 @@
 import os
 import sys
 import glob
+import time
+import json
+import shutil
+import hashlib
 import argparse
+from functools import partial
 
-from ABF1Converter import ABF1Converter
+from ABF1Converter import ABF1Converter, COMPRESSION_PROFILES, OUTPUT_BACKENDS, READ_PATTERNS
+from conversion_catalog import ConversionCatalog
+from batch_tools import run_jobs, report_failures, save_json
 
+# Name of the manifest written next to the output files in incremental mode
+MANIFEST_NAME = "abf_to_nwb_manifest.json"
 
-def abf_to_nwb(inputPath, outFolder, outputMetadata, acquisitionChannelName, stimulusChannelName, overwrite):
+
+def output_file(inputFile, outFolder, backend="hdf5"):
+    """
+    Returns the path of the NWB file, or zarr directory store, an ABF file is converted to.
+    """
+
+    root, _ = os.path.splitext(os.path.basename(inputFile))
+
+    if backend == "zarr":
+        return os.path.join(outFolder, root + ".nwb.zarr")
+
+    return os.path.join(outFolder, root + ".nwb")
+
+
+def convert_file(inputFile, outFolder, outputMetadata, overwrite, **converterOptions):
+    """
+    Converts a single ABF file to an NWB file in the output folder.
+
+    The remaining keyword arguments are passed on to ABF1Converter.
+    Returns the path of the output file, the number of bytes read from the input and the profile report of the
+    conversion, which is None unless profiling.
+    """
+
+    fileName = os.path.basename(inputFile)
+
+    print(f"Converting {fileName}...")
+
+    outFile = output_file(inputFile, outFolder, converterOptions.get("backend", "hdf5"))
+
+    if os.path.exists(outFile):
+        if overwrite and os.path.isdir(outFile):
+            shutil.rmtree(outFile)
+        elif overwrite:
+            os.unlink(outFile)
+        elif not converterOptions.get("append"):
+            raise ValueError(f"The file {outFile} already exists.")
+
+    conv = ABF1Converter(inputFile, outFile, **converterOptions)
+    conv.convert()
+
+    if outputMetadata:
+        conv._outputMetadata()
+
+    return outFile, os.path.getsize(inputFile), conv.profileReport
+
+
+def plan_conversions(files, outFolder, jobs, overwrite, **converterOptions):
+    """
+    Prints the output file planned for every input with its estimated size and conversion time, and the totals
+    per compression profile, without writing anything.
+
+    The throughput is calibrated on the first input which can be read and reused for the others. The remaining
+    keyword arguments are passed on to ABF1Converter.
+    Returns the inputs whose output already exists and would not be replaced, and the inputs which could not be
+    planned, with their errors.
+    """
+
+    failures = {}
+    plans = []
+    calibration = None
+
+    for inputFile in sorted(files):
+        fileName = os.path.basename(inputFile)
+        outFile = output_file(inputFile, outFolder, converterOptions.get("backend", "hdf5"))
+
+        if os.path.exists(outFile) and not overwrite and not converterOptions.get("append"):
+            failures[fileName] = ValueError(f"The file {outFile} already exists.")
+            print(f"{fileName}: {outFile} already exists.")
+            continue
+
+        try:
+            plan = ABF1Converter(inputFile, outFile, dryRun=True, **converterOptions).planConversion(calibration)
+        except Exception as e:
+            failures[fileName] = e
+            print(f"Failed to plan {fileName}: {e}")
+            continue
+
+        calibration = plan["calibration"]
+        plans += [plan]
+
+        if plan["compression"] in plan["estimates"]:
+            estimate = plan["estimates"][plan["compression"]]
+            size = f"{estimate['bytes'] / 1e6:.1f} MB in {estimate['seconds']:.1f} s"
+        else:
+            # The auto profile is only chosen while converting, so the range over all profiles is shown
+            outputBytes = [estimate["bytes"] for estimate in plan["estimates"].values()]
+            size = f"{min(outputBytes) / 1e6:.1f} to {max(outputBytes) / 1e6:.1f} MB"
+
+        print(f"{fileName} -> {outFile}: {plan['sweeps']} sweeps, {plan['series']} series, {size}")
+
+    if plans:
+        # The files are spread over the workers, so the wall time shrinks with the number of concurrent jobs
+        workers = min(jobs, len(plans))
+        dataBytes = sum([plan["data_bytes"] for plan in plans])
+
+        print(f"Planned {len(plans)} output file(s) with {sum([plan['sweeps'] for plan in plans])} sweeps "
+              f"and {dataBytes / 1e6:.1f} MB of sweep data:")
+
+        for compression in calibration["profiles"]:
+            outputBytes = sum([plan["estimates"][compression]["bytes"] for plan in plans])
+            seconds = sum([plan["estimates"][compression]["seconds"] for plan in plans])
+
+            print(f"  {compression}: {outputBytes / 1e6:.1f} MB in {seconds / workers:.1f} s with {workers} job(s)")
+
+    report_failures(failures)
+
+    return failures
+
+
+def file_hash(path):
+    """
+    Returns the SHA-256 hex digest of the contents of a file.
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_manifest(outFolder):
+    """
+    Returns the manifest entries of the previous runs in the output folder, by input file name.
+    """
+
+    manifestPath = os.path.join(outFolder, MANIFEST_NAME)
+
+    if not os.path.exists(manifestPath):
+        return {}
+
+    with open(manifestPath) as f:
+        return json.load(f)
+
+
+def save_manifest(outFolder, manifest):
+    """
+    Writes the manifest to the output folder, replacing the previous one only once it is complete.
+    """
+
+    save_json(os.path.join(outFolder, MANIFEST_NAME), manifest, sort_keys=True, indent=4)
+
+
+def is_unchanged(entry, inputFile, outFile, settings):
+    """
+    Checks whether an input was converted with the same settings, and has not changed since, according to its
+    manifest entry.
+
+    Size and modification time are compared first, the content hash is only computed when they differ.
+    The entry is updated when only the modification time changed.
+    """
+
+    if entry is None or entry["settings"] != settings or not os.path.exists(outFile):
+        return False
+
+    stat = os.stat(inputFile)
+
+    if entry["size"] != stat.st_size:
+        return False
+
+    if entry["mtime"] == stat.st_mtime:
+        return True
+
+    if entry["sha256"] != file_hash(inputFile):
+        return False
+
+    entry["mtime"] = stat.st_mtime
+
+    return True
+
+
+def abf_to_nwb(inputPath, outFolder, outputMetadata, acquisitionChannelName, stimulusChannelName, overwrite, jobs=1,
+               streaming=False, nativeReader=False, rawData=False, compression="default", compressionTimeBudget=0.05,
+               layout="series", sweepTable=False, append=False, incremental=False, profile=None,
+               maxMemory=None, compressionThreads=1, catalog=None, dryRun=False, backend="hdf5", readPattern=None,
+               readWindow=0.1):
     """
     Sample file handling script for NWB conversion.
 
@@ -16,6 +202,27 @@ def abf_to_nwb(inputPath, outFolder, outputMetadata, acquisitionChannelName, sti
     to the folder specified by the second command line argument.
 
     NWB Files organized by cell, with assumption that each abf file corresponds to each cell
+
+    With jobs > 1 the files are converted concurrently in a process pool. In both modes a failing file is
+    reported and the remaining files are still converted.
+
+    With incremental, a manifest of the size, modification time and content hash of every converted input, and
+    of the converter settings, is kept in the output folder. Inputs which are unchanged since the last run are
+    skipped, changed and new ones are converted, replacing their previous output.
+
+    With profile, the per-stage timing report of every converted file is written as JSON to the given path.
+
+    maxMemory is the budget in bytes for the sweep data held by each conversion, so with jobs > 1 up to jobs times
+    as much is used at once.
+
+    With catalog, the converted files and their sweeps are recorded in the SQLite conversion catalog at the given
+    path, in one transaction at the end of the batch.
+
+    With the zarr backend, every ABF file is converted into a zarr directory store named after it with the
+    extension .nwb.zarr, see nwb_zarr.py to convert these to NWB files.
+
+    With dryRun, only the planned output files are listed with their estimated sizes and conversion times,
+    see plan_conversions, and nothing is written.
     """
 
     if not os.path.exists(inputPath):
@@ -34,26 +241,100 @@ def abf_to_nwb(inputPath, outFolder, outputMetadata, acquisitionChannelName, sti
     if len(files) == 0:
         raise ValueError(f"Invalid path {inputPath} does not contain any ABF files.")
 
-    for inputFile in files:
+    if overwrite and append:
+        raise ValueError("Output files can either be overwritten or appended to, not both.")
 
-        fileName = os.path.basename(inputFile)
-        root, _ = os.path.splitext(fileName)
+    if incremental and append:
+        raise ValueError("Incremental runs replace changed outputs and can not be combined with appending.")
+
+    if jobs < 1:
+        raise ValueError(f"Invalid number of jobs {jobs}: must be at least 1.")
 
-        print(f"Converting {fileName}...")
+    convertOptions = dict(outputMetadata=outputMetadata, overwrite=overwrite,
+                          acquisitionChannelName=acquisitionChannelName, stimulusChannelName=stimulusChannelName,
+                          streaming=streaming, nativeReader=nativeReader, rawData=rawData,
+                          compression=compression, compressionTimeBudget=compressionTimeBudget, layout=layout,
+                          sweepTable=sweepTable, append=append, profile=profile is not None,
+                          maxMemory=maxMemory, compressionThreads=compressionThreads, backend=backend,
+                          readPattern=readPattern, readWindow=readWindow)
 
-        outFile = os.path.join(outFolder, root + ".nwb")
+    startTime = time.perf_counter()
+    bytesIn = 0
+    failures = {}
+    converted = []
+    reports = []
+    skipped = 0
 
-        if os.path.exists(outFile):
-            if overwrite:
-                os.unlink(outFile)
+    if incremental:
+        manifest = load_manifest(outFolder)
+
+        # Every option except the handling of existing outputs determines the contents of an output file
+        settings = {key: value for key, value in convertOptions.items()
+                    if key not in ("overwrite", "outputMetadata", "append", "profile")}
+
+        changedFiles = []
+        for inputFile in files:
+            fileName = os.path.basename(inputFile)
+            outFile = output_file(inputFile, outFolder, backend)
+
+            if is_unchanged(manifest.get(fileName), inputFile, outFile, settings):
+                skipped += 1
             else:
-                raise ValueError(f"The file {outFile} already exists.")
+                changedFiles += [inputFile]
+
+        print(f"Skipping {skipped} unchanged file(s), converting {len(changedFiles)}.")
+
+        files = changedFiles
+        convertOptions["overwrite"] = True
+
+    if dryRun:
+        plannerOptions = {key: value for key, value in convertOptions.items()
+                          if key not in ("outputMetadata", "overwrite", "profile")}
 
-        conv = ABF1Converter(inputFile, outFile, acquisitionChannelName=acquisitionChannelName, stimulusChannelName=stimulusChannelName)
-        conv.convert()
+        return plan_conversions(files, outFolder, jobs, convertOptions["overwrite"], **plannerOptions)
 
-        if outputMetadata:
-            conv._outputMetadata()
+    inputFiles = {os.path.basename(inputFile): inputFile for inputFile in files}
+    tasks = {fileName: (inputFile,) for fileName, inputFile in inputFiles.items()}
+
+    for fileName, (outFile, size, report) in run_jobs(partial(convert_file, outFolder=outFolder, **convertOptions),
+                                                      tasks, failures, jobs):
+        bytesIn += size
+        converted += [inputFiles[fileName]]
+        reports += [report]
+        print(f"Converted {fileName} to {outFile}.")
+
+    if incremental:
+        for inputFile in converted:
+            stat = os.stat(inputFile)
+            manifest[os.path.basename(inputFile)] = {"size": stat.st_size,
+                                                     "mtime": stat.st_mtime,
+                                                     "sha256": file_hash(inputFile),
+                                                     "settings": settings}
+
+        save_manifest(outFolder, manifest)
+
+    if catalog is not None:
+        with ConversionCatalog(catalog) as conversionCatalog:
+            for inputFile in converted:
+                conversionCatalog.record(output_file(inputFile, outFolder, backend), [inputFile])
+
+    elapsed = time.perf_counter() - startTime
+    succeeded = len(converted)
+    megabytes = bytesIn / 1e6
+
+    print(f"Converted {succeeded} of {len(files)} files ({megabytes:.1f} MB) in {elapsed:.1f} s: "
+          f"{succeeded / elapsed:.2f} files/s, {megabytes / elapsed:.2f} MB/s.")
+
+    if profile is not None:
+        with open(profile, "w") as f:
+            json.dump({"seconds": elapsed, "bytes_in": bytesIn, "jobs": jobs,
+                       "files": sorted(reports, key=lambda report: report["input"])}, f, indent=4)
+
+        print(f"Wrote the profile report to {profile}.")
+
+    report_failures(failures)
+
+    return failures
 
 
 def main():
@@ -69,13 +350,67 @@ def main():
                         help="Helper for debugging which outputs HTML files with the metadata contents of the files.")
     parser.add_argument("--overwrite", action="store_true", default=False,
                         help="Overwrite output files.")
+    parser.add_argument("--append", action="store_true", default=False,
+                        help="Add ABF files which are not yet present to existing output files.")
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="Only convert inputs which changed since the last run, according to a manifest "
+                             "kept in the output folder.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of files to convert concurrently.")
+    parser.add_argument("--streaming", action="store_true", default=False,
+                        help="Read the sweeps from the ABF files while writing instead of holding them in memory.")
+    parser.add_argument("--nativeReader", action="store_true", default=False,
+                        help="Read the sweeps through the memory-mapped ABF1 reader instead of pyabf.")
+    parser.add_argument("--rawData", action="store_true", default=False,
+                        help="Store the recorded int16 ADC counts with the ABF scaling folded into the conversion.")
+    parser.add_argument("--compression", default="default", choices=list(COMPRESSION_PROFILES) + ["auto"],
+                        help="Compression profile for the sweep data, auto picks one from a trial on the first sweeps.")
+    parser.add_argument("--compressionTimeBudget", type=float, default=0.05,
+                        help="Seconds per MB of sweep data the auto compression profile may spend.")
+    parser.add_argument("--compressionThreads", type=int, default=1,
+                        help="Number of threads compressing the sweep data of each conversion (gzip profiles only).")
+    parser.add_argument("--layout", default="series", choices=["series", "stacked"],
+                        help="Write one series per sweep, or stack the sweeps of each channel into one dataset.")
+    parser.add_argument("--readPattern", default=None, choices=READ_PATTERNS,
+                        help="Chunk the sweep data for reading whole sweeps, short windows, or the same window "
+                             "across the sweeps of the stacked layout.")
+    parser.add_argument("--readWindow", type=float, default=0.1, metavar="SECONDS",
+                        help="Length of the windows read with the window and rows read patterns.")
+    parser.add_argument("--sweepTable", action="store_true", default=False,
+                        help="Write the sweep metadata once into a table instead of into every series description.")
+    parser.add_argument("--maxMemory", type=float, default=None, metavar="MB",
+                        help="Memory budget in MB for the sweep data of each conversion, the sweeps are streamed "
+                             "into the output file.")
+    parser.add_argument("--backend", default="hdf5", choices=OUTPUT_BACKENDS,
+                        help="Write NWB files, or zarr directory stores with every chunk in a file of its own.")
+    parser.add_argument("--catalog", default=None,
+                        help="SQLite conversion catalog to record the converted files and their sweeps in.")
+    parser.add_argument("--dryRun", "--dry-run", action="store_true", default=False,
+                        help="List the planned output files with their estimated size and conversion time per "
+                             "compression profile, calibrated on the first file, without writing anything.")
+    parser.add_argument("--profile", default=None, metavar="REPORT.json",
+                        help="Write a JSON report of the time, bytes, sweep throughput and peak memory of every "
+                             "conversion stage.")
     parser.add_argument("fileOrFolder", help="ABF file/folder  to convert.")
 
     args = parser.parse_args()
 
-    abf_to_nwb(args.fileOrFolder, args.outputPath, outputMetadata=args.outputMetadata,
-               acquisitionChannelName=args.acquisitionChannelName,
-               stimulusChannelName=args.stimulusChannelName, overwrite=args.overwrite)
+    maxMemory = None if args.maxMemory is None else int(args.maxMemory * 1e6)
+
+    failures = abf_to_nwb(args.fileOrFolder, args.outputPath, outputMetadata=args.outputMetadata,
+                          acquisitionChannelName=args.acquisitionChannelName,
+                          stimulusChannelName=args.stimulusChannelName, overwrite=args.overwrite,
+                          jobs=args.jobs, streaming=args.streaming,
+                          nativeReader=args.nativeReader, rawData=args.rawData,
+                          compression=args.compression, compressionTimeBudget=args.compressionTimeBudget,
+                          layout=args.layout, sweepTable=args.sweepTable, append=args.append,
+                          incremental=args.incremental, profile=args.profile,
+                          maxMemory=maxMemory, compressionThreads=args.compressionThreads,
+                          catalog=args.catalog, dryRun=args.dryRun, backend=args.backend,
+                          readPattern=args.readPattern, readWindow=args.readWindow)
+
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
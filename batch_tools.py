@@ -0,0 +1,68 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def save_json(path, data, **dumpOptions):
+    """
+    Writes data as JSON to path, replacing the previous file only once the new one is complete, so that an
+    interrupted run never leaves a truncated file behind.
+
+    dumpOptions are passed on to json.dump.
+    """
+
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, **dumpOptions)
+
+    os.replace(path + ".tmp", path)
+
+
+def run_jobs(function, tasks, failures, jobs=1, action="convert"):
+    """
+    Runs function on the arguments of every task, one task after the other with a single job, or in a pool of
+    jobs worker processes.
+
+    tasks maps the names of the tasks to their argument tuples. Yields the name and result of every task which
+    succeeded, as it completes. Both modes handle errors alike: the error of a failing task is printed and stored
+    in failures by name, and the remaining tasks still run.
+    """
+
+    if jobs == 1:
+        for name, args in tasks.items():
+            try:
+                result = function(*args)
+            except Exception as e:
+                failures[name] = e
+                print(f"Failed to {action} {name}: {e}")
+                continue
+
+            yield name, result
+
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(function, *args): name for name, args in tasks.items()}
+
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failures[name] = e
+                print(f"Failed to {action} {name}: {e}")
+                continue
+
+            yield name, result
+
+
+def report_failures(failures, noun="file"):
+    """
+    Prints the errors of the failed tasks, sorted by name.
+    """
+
+    if not failures:
+        return
+
+    print(f"{len(failures)} {noun}(s) failed:")
+    for name, error in sorted(failures.items()):
+        print(f"  {name}: {error}")
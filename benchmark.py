@@ -0,0 +1,272 @@
+#!/bin/env python
+
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+import itertools
+import subprocess
+import tempfile
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ABF1Converter import ABF1Converter, COMPRESSION_PROFILES, READ_PATTERNS, peakMemory
+from batch_tools import save_json
+
+# ABF1 files are organized in blocks of 512 bytes, the extended header of ABF 1.8 takes the first 12
+ABF1_BLOCK_SIZE = 512
+ABF1_HEADER_BLOCKS = 12
+
+# Fractional slowdown of a metric against the baseline which is reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+
+def writeSyntheticABF1(path, sweepCount, sweepPointCount, channelCount=1, clampMode=1, dataRate=20000, seed=0):
+    """
+    Writes an episodic ABF1 file with a noisy sine wave on every channel, as recorded by Clampex.
+
+    clampMode is stored as nExperimentType, 0 for voltage clamp and 1 for current clamp. It also sets the units
+    of the recorded and command channels. Only the header fields read by pyabf and ABF1Converter are filled in.
+    """
+
+    if channelCount < 1 or channelCount > 16:
+        raise ValueError(f"Invalid number of channels {channelCount}: ABF1 files have 1 to 16 channels.")
+
+    if clampMode == 0:
+        adcUnits, dacUnits = "pA", "mV"
+    elif clampMode == 1:
+        adcUnits, dacUnits = "mV", "pA"
+    else:
+        raise ValueError(f"Unsupported clamp mode {clampMode}")
+
+    pointCount = sweepCount * sweepPointCount * channelCount
+    header = bytearray(ABF1_HEADER_BLOCKS * ABF1_BLOCK_SIZE)
+
+    struct.pack_into("4s", header, 0, b"ABF ")  # fFileSignature
+    struct.pack_into("f", header, 4, 1.83)  # fFileVersionNumber
+    struct.pack_into("h", header, 8, 5)  # nOperationMode (episodic)
+    struct.pack_into("i", header, 10, pointCount)  # lActualAcqLength
+    struct.pack_into("i", header, 16, sweepCount)  # lActualEpisodes
+    struct.pack_into("i", header, 20, 20180426)  # lFileStartDate
+    struct.pack_into("i", header, 24, 3600)  # lFileStartTime
+    struct.pack_into("i", header, 40, ABF1_HEADER_BLOCKS)  # lDataSectionPtr
+    struct.pack_into("h", header, 100, 0)  # nDataFormat (int16)
+    struct.pack_into("h", header, 120, channelCount)  # nADCNumChannels
+    struct.pack_into("f", header, 122, 1e6 / dataRate / channelCount)  # fADCSampleInterval
+    struct.pack_into("i", header, 138, sweepPointCount * channelCount)  # lNumSamplesPerEpisode
+    struct.pack_into("f", header, 244, 10.0)  # fADCRange
+    struct.pack_into("i", header, 252, 2 ** 15)  # lADCResolution
+    struct.pack_into("h", header, 260, clampMode)  # nExperimentType
+    struct.pack_into("16s", header, 294, b"Clampex".ljust(16))  # sCreatorInfo
+
+    for i in range(16):
+        struct.pack_into("h", header, 410 + i * 2, i if i < channelCount else -1)  # nADCSamplingSeq
+        struct.pack_into("10s", header, 442 + i * 10, f"IN {i}".ljust(10).encode())  # sADCChannelName
+        struct.pack_into("8s", header, 602 + i * 8, adcUnits.ljust(8).encode())  # sADCUnits
+        struct.pack_into("f", header, 730 + i * 4, 1.0)  # fADCProgrammableGain
+        struct.pack_into("f", header, 922 + i * 4, 0.1)  # fInstrumentScaleFactor
+        struct.pack_into("f", header, 1050 + i * 4, 1.0)  # fSignalGain
+
+    for i in range(4):
+        struct.pack_into("10s", header, 1306 + i * 10, f"OUT {i}".ljust(10).encode())  # sDACChannelName
+        struct.pack_into("8s", header, 1346 + i * 8, dacUnits.ljust(8).encode())  # sDACChannelUnits
+
+    struct.pack_into("4h", header, 5798, 9, 2, 0, 0)  # Creator version 9.2
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(sweepPointCount) / dataRate
+    counts = np.empty((sweepCount, sweepPointCount, channelCount), dtype=np.int16)
+
+    for channel in range(channelCount):
+        signal = 8000 * np.sin(2 * np.pi * (5 + channel) * t)
+        noise = rng.normal(0, 200, (sweepCount, sweepPointCount))
+        counts[:, :, channel] = np.clip(signal + noise, -32768, 32767)
+
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(counts.tobytes())
+
+        # Pad the data section to a whole number of blocks
+        f.write(bytes(-f.tell() % ABF1_BLOCK_SIZE))
+
+
+def runConfiguration(configuration, converterOptions, workFolder):
+    """
+    Generates the synthetic file of a configuration, converts it and returns the measurements.
+
+    Runs in a fresh worker process per configuration, so that the peak memory is that of this conversion only.
+    """
+
+    name = "_".join(f"{key}{value}" for key, value in configuration.items())
+    inputFile = os.path.join(workFolder, name + ".abf")
+    outputFile = os.path.join(workFolder, name + ".nwb")
+
+    writeSyntheticABF1(inputFile, **configuration)
+
+    sweepBytes = configuration["sweepCount"] * configuration["sweepPointCount"] * configuration["channelCount"] * 2
+
+    startTime = time.perf_counter()
+    ABF1Converter(inputFile, outputFile, **converterOptions).convert()
+    elapsed = time.perf_counter() - startTime
+
+    result = {"configuration": configuration,
+              "seconds": elapsed,
+              "megabytes_per_second": sweepBytes / 1e6 / elapsed,
+              "sweeps_per_second": configuration["sweepCount"] / elapsed,
+              "peak_memory": peakMemory(),
+              "input_size": os.path.getsize(inputFile),
+              "output_size": os.path.getsize(outputFile)}
+
+    os.unlink(inputFile)
+    os.unlink(outputFile)
+
+    return result
+
+
+def gitRevision():
+    """
+    Returns the commit of the working tree, or None outside of a git repository.
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, converterOptions):
+    """
+    Prints the change of every configuration against the latest run in a baseline results file which was made
+    with the same converter options.
+
+    Returns the number of configurations which are slower than the baseline by more than REGRESSION_THRESHOLD.
+    """
+
+    # Round trip through JSON, as the options are stored in the results file
+    converterOptions = json.loads(json.dumps(converterOptions))
+    runs = [run for run in baseline if run.get("converter_options") == converterOptions]
+
+    if not runs:
+        print(f"The baseline has no run with the converter options {converterOptions}, nothing to compare.")
+        return 0
+
+    baselineResults = {json.dumps(result["configuration"], sort_keys=True): result
+                       for result in runs[-1]["results"]}
+    regressions = 0
+
+    for result in results:
+        previous = baselineResults.get(json.dumps(result["configuration"], sort_keys=True))
+
+        if previous is None:
+            continue
+
+        change = result["megabytes_per_second"] / previous["megabytes_per_second"] - 1
+        regressed = change < -REGRESSION_THRESHOLD
+        regressions += regressed
+
+        print(f"{result['configuration']}: {change:+.1%} MB/s, "
+              f"{result['output_size'] / previous['output_size'] - 1:+.1%} output size"
+              f"{' REGRESSION' if regressed else ''}")
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark ABF1Converter on synthetic ABF1 files.")
+    parser.add_argument("--sweeps", type=int, nargs="+", default=[10, 100],
+                        help="Numbers of sweeps per file.")
+    parser.add_argument("--samples", type=int, nargs="+", default=[10000, 100000],
+                        help="Numbers of samples per sweep and channel.")
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 2],
+                        help="Numbers of recorded channels.")
+    parser.add_argument("--clampModes", type=int, nargs="+", default=[1], choices=[0, 1],
+                        help="Clamp modes (0: voltage clamp, 1: current clamp).")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of conversions per configuration, the fastest one is kept.")
+    parser.add_argument("--streaming", action="store_true", default=False,
+                        help="Convert in streaming mode, as abf_to_nwb.py --streaming.")
+    parser.add_argument("--nativeReader", action="store_true", default=False,
+                        help="Convert with the memory-mapped ABF1 reader, as abf_to_nwb.py --nativeReader.")
+    parser.add_argument("--rawData", action="store_true", default=False,
+                        help="Store the int16 ADC counts, as abf_to_nwb.py --rawData.")
+    parser.add_argument("--compression", default="default", choices=list(COMPRESSION_PROFILES) + ["auto"],
+                        help="Compression profile of the conversions.")
+    parser.add_argument("--compressionThreads", type=int, default=1,
+                        help="Number of threads compressing the sweep data.")
+    parser.add_argument("--layout", default="series", choices=["series", "stacked"],
+                        help="Layout of the sweeps in the NWB files.")
+    parser.add_argument("--readPattern", default=None, choices=READ_PATTERNS,
+                        help="Read pattern the chunk shapes are chosen for, as abf_to_nwb.py --readPattern.")
+    parser.add_argument("--results", default="benchmark_results.json",
+                        help="JSON file the results are appended to.")
+    parser.add_argument("--compare", default=None,
+                        help="Results file whose latest run is compared against, exits with 1 on a regression.")
+
+    args = parser.parse_args()
+
+    converterOptions = dict(streaming=args.streaming, nativeReader=args.nativeReader, rawData=args.rawData,
+                            compression=args.compression, compressionThreads=args.compressionThreads,
+                            layout=args.layout, readPattern=args.readPattern)
+
+    # Read before the results are appended, which may be to the same file
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as workFolder:
+        for sweepCount, sweepPointCount, channelCount, clampMode in itertools.product(
+                args.sweeps, args.samples, args.channels, args.clampModes):
+
+            configuration = dict(sweepCount=sweepCount, sweepPointCount=sweepPointCount,
+                                 channelCount=channelCount, clampMode=clampMode)
+            runs = []
+
+            for _ in range(args.repeat):
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    runs += [executor.submit(runConfiguration, configuration, converterOptions, workFolder).result()]
+
+            result = min(runs, key=lambda run: run["seconds"])
+            results += [result]
+
+            # The peak memory is not available on Windows
+            if result["peak_memory"] is None:
+                peak = "n/a"
+            else:
+                peak = f"{result['peak_memory'] / 1e6:.0f} MB"
+
+            print(f"{configuration}: {result['megabytes_per_second']:.2f} MB/s, "
+                  f"{result['sweeps_per_second']:.1f} sweeps/s, peak memory {peak}, "
+                  f"output {result['output_size'] / 1e6:.2f} MB")
+
+    history = []
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            history = json.load(f)
+
+    history += [{"date": datetime.now().isoformat(timespec="seconds"),
+                 "revision": gitRevision(),
+                 "python": sys.version.split()[0],
+                 "converter_options": converterOptions,
+                 "results": results}]
+
+    save_json(args.results, history, indent=4)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, converterOptions)
+
+        if regressions:
+            print(f"{regressions} configuration(s) regressed by more than {REGRESSION_THRESHOLD:.0%}.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
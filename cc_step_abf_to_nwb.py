@@ -1,10 +1,50 @@
 import os
 import sys
 import glob
+import json
 import pandas as pd
-import csv
 from datetime import datetime
 from ABF1Converter import ABF1Converter
+from conversion_catalog import ConversionCatalog
+from batch_tools import save_json
+
+# Spreadsheet with the recording date of every file, and the catalog collecting the metadata of the conversions
+METADATA_EXCEL = r"C:\NWB\Files\Data\Step\Demographic information Feb-05-2019-_Request_HM.xlsx"
+METADATA_CATALOG = r"C:\NWB\Files\NWB Files\Step\metadata.sqlite"
+
+
+def load_dates(excel):
+
+    """
+    Returns the recording date of every file name listed in the spreadsheet.
+
+    The spreadsheet has one column per date, holding the names of the files recorded on that day. The index is
+    cached in a JSON file next to the spreadsheet, and only rebuilt when the modification time of the spreadsheet
+    changes.
+    """
+
+    cachePath = os.path.splitext(excel)[0] + "_dates.json"
+    mtime = os.path.getmtime(excel)
+
+    if os.path.exists(cachePath):
+        with open(cachePath) as f:
+            cache = json.load(f)
+
+        if cache["mtime"] == mtime:
+            return cache["dates"]
+
+    metaSheet = pd.read_excel(excel, sheet_name='Layer 5- cells', header=2, nrows=12)
+    dates = {}
+    for col in metaSheet.columns:
+        for fileName in metaSheet[col].tolist():
+            # Empty cells are read as NaN
+            if isinstance(fileName, str):
+                dates[fileName] = f"{col.date()}"
+
+    save_json(cachePath, {"mtime": mtime, "dates": dates}, indent=4)
+
+    return dates
+
 
 def abf_to_nwb(inputPath, outFolder):
 
@@ -14,7 +54,7 @@ def abf_to_nwb(inputPath, outFolder):
 
     NWB Files organized by cell, with assumption that each abf file corresponds to each cell
 
-    Reads data from a spreadsheet and writes important metadata to a CSV file
+    Reads data from a spreadsheet and writes important metadata to the conversion catalog
 
     """
 
@@ -50,42 +90,44 @@ def abf_to_nwb(inputPath, outFolder):
 
         files = glob.glob(inputPath + "/*.abf")
 
-        # Parse excel spreadsheet to gather date information and store into a dictionary
+        # Index the file names of the excel spreadsheet by date
+
+        dates = load_dates(METADATA_EXCEL)
+        rows = []
+
+        try:
+            for file in files:
 
-        excel = r"C:\NWB\Files\Data\Step\Demographic information Feb-05-2019-_Request_HM.xlsx"
-        metaSheet = pd.read_excel(excel, sheet_name='Layer 5- cells', header=2, nrows=12)
-        dates = {}
-        for col in metaSheet.columns:
-            colList = metaSheet[col].tolist()
-            dates[f"{col.date()}"] = colList
+                fileName = os.path.basename(file)
+                root, ext = os.path.splitext(fileName)
 
-        for file in files:
+                # Match date information
+                if fileName not in dates:
+                    raise ValueError(f"The file {fileName} is not listed in {METADATA_EXCEL}.")
 
-            fileName = os.path.basename(file)
-            root, ext = os.path.splitext(fileName)
+                expDate = dates[fileName]
 
-            # Match date information
-            for date, files in dates.items():
-                for i in range(len(files)):
-                    if files[i] == fileName:
-                        expDate = date
+                print(f"Converting {fileName}...")
 
-            print(f"Converting {fileName}...")
+                outFile = os.path.join(outFolder, expDate + "-C" + root[-3:] + ".nwb")
 
-            outFile = os.path.join(outFolder, expDate + "-C" + root[-3:] + ".nwb")
+                if os.path.exists(outFile):
+                    raise ValueError(f"The file {outFile} already exists.")
 
-            if os.path.exists(outFile):
-                raise ValueError(f"The file {outFile} already exists.")
+                conv = ABF1Converter(inputPath, outFile)
+                conv.convert()
 
-            ABF1Converter(inputPath, outFile).convert()
+                rows += [(outFile, [abfFile.abfFilePath for abfFile in conv.abfFiles], expDate, root[-3:])]
 
-            # Append to metadata CSV file
+        finally:
 
-            with open(r"C:\NWB\Files\NWB Files\Step\metadata.csv", 'a') as csvFile:
-                writer = csv.writer(csvFile)
-                writer.writerow([f'{fileName}', f'{expDate}', '5', 'Homeira', f'{outFile}'])
+            # Record the files converted so far in the catalog in one transaction
 
-            csvFile.close()
+            if rows:
+                with ConversionCatalog(METADATA_CATALOG) as catalog:
+                    for outFile, abfFilePaths, expDate, cell in rows:
+                        catalog.record(outFile, abfFilePaths, date=expDate, cell=cell, layer='5',
+                                       experimenter='Homeira')
 
         # date = ""
         # for dirpath, dirnames, filenames in os.walk(inputPath):
@@ -0,0 +1,195 @@
+#!/bin/env python
+
+import os
+import sqlite3
+import argparse
+from datetime import datetime
+
+import pyabf
+
+# One row per output file, and one per sweep of every ABF file in it
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    output_path TEXT NOT NULL UNIQUE,
+    date TEXT,
+    cell TEXT,
+    layer TEXT,
+    experimenter TEXT,
+    clamp_mode INTEGER,
+    converted TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sweeps (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    abf_file TEXT NOT NULL,
+    file_index INTEGER NOT NULL,
+    sweep_number INTEGER NOT NULL,
+    protocol TEXT,
+    clamp_mode INTEGER,
+    sample_count INTEGER,
+    data_rate REAL
+);
+CREATE INDEX IF NOT EXISTS files_date ON files(date);
+CREATE INDEX IF NOT EXISTS files_cell ON files(cell);
+CREATE INDEX IF NOT EXISTS files_layer ON files(layer);
+CREATE INDEX IF NOT EXISTS files_experimenter ON files(experimenter);
+CREATE INDEX IF NOT EXISTS files_clamp_mode ON files(clamp_mode);
+CREATE INDEX IF NOT EXISTS sweeps_file_id ON sweeps(file_id);
+CREATE INDEX IF NOT EXISTS sweeps_protocol ON sweeps(protocol);
+"""
+
+
+class ConversionCatalog:
+
+    """
+    SQLite catalog of the NWB files written by the conversion scripts, and of the sweeps they contain.
+
+    Used as a context manager, all records written inside the block form one transaction, which is committed at
+    the end of the block and rolled back on an error.
+
+    Parameters
+    ----------
+    catalogPath: path of the SQLite database, created if it does not exist
+    """
+
+    def __init__(self, catalogPath):
+
+        self.catalogPath = catalogPath
+        self.connection = sqlite3.connect(catalogPath)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(CATALOG_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+
+        if excType is None:
+            self.connection.commit()
+        else:
+            self.connection.rollback()
+
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, outputPath, abfFilePaths, date=None, cell=None, layer=None, experimenter=None, replace=True):
+
+        """
+        Records an output file and the sweeps of the ABF files converted into it, in the order they were converted.
+
+        Only the headers of the ABF files are read. The date defaults to the recording date of the first ABF file,
+        the cell to the name of the output file, and the clamp mode is taken from the first ABF file as by
+        ABF1Converter. With replace, previously recorded sweeps of the output file are dropped, otherwise the new
+        sweeps are added to them, as when appending to an output file.
+        """
+
+        abfFiles = [pyabf.ABF(abfFilePath, loadData=False) for abfFilePath in abfFilePaths]
+
+        if date is None:
+            date = str(abfFiles[0].abfDateTime.date())
+
+        if cell is None:
+            cell = os.path.basename(outputPath)
+
+            # Also strips both extensions of zarr directory stores
+            for extension in (".zarr", ".nwb"):
+                if cell.endswith(extension):
+                    cell = cell[:-len(extension)]
+
+        outputPath = os.path.abspath(outputPath)
+        clampMode = abfFiles[0]._headerV1.nExperimentType
+
+        self.connection.execute("INSERT INTO files (output_path, date, cell, layer, experimenter, clamp_mode, converted) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                                "ON CONFLICT (output_path) DO UPDATE SET date = excluded.date, cell = excluded.cell, "
+                                "layer = excluded.layer, experimenter = excluded.experimenter, "
+                                "clamp_mode = excluded.clamp_mode, converted = excluded.converted",
+                                (outputPath, date, cell, layer, experimenter, clampMode,
+                                 datetime.now().isoformat(timespec="seconds")))
+
+        fileId, = self.connection.execute("SELECT id FROM files WHERE output_path = ?", (outputPath,)).fetchone()
+
+        if replace:
+            self.connection.execute("DELETE FROM sweeps WHERE file_id = ?", (fileId,))
+            firstFileIndex = 0
+        else:
+            firstFileIndex, = self.connection.execute("SELECT COUNT(DISTINCT abf_file) FROM sweeps WHERE file_id = ?",
+                                                      (fileId,)).fetchone()
+
+        rows = []
+        for idx, abfFile in enumerate(abfFiles, firstFileIndex):
+            for i in range(abfFile.sweepCount):
+                rows += [(fileId, os.path.basename(abfFile.abfFilePath), idx, i, abfFile.protocol,
+                          abfFile._headerV1.nExperimentType, abfFile.sweepPointCount, abfFile.dataRate)]
+
+        self.connection.executemany("INSERT INTO sweeps (file_id, abf_file, file_index, sweep_number, protocol, "
+                                    "clamp_mode, sample_count, data_rate) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def select(self, date=None, cell=None, layer=None, experimenter=None, protocol=None, clampMode=None):
+
+        """
+        Returns the recorded output files matching all given criteria as dicts, sorted by output path.
+
+        protocol matches the files which contain at least one sweep recorded with the protocol.
+        """
+
+        conditions = []
+        parameters = []
+
+        for column, value in [("date", date), ("cell", cell), ("layer", layer), ("experimenter", experimenter),
+                              ("clamp_mode", clampMode)]:
+            if value is not None:
+                conditions += [f"{column} = ?"]
+                parameters += [value]
+
+        if protocol is not None:
+            conditions += ["id IN (SELECT file_id FROM sweeps WHERE protocol = ?)"]
+            parameters += [protocol]
+
+        query = "SELECT * FROM files"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        return [dict(row) for row in self.connection.execute(query + " ORDER BY output_path", parameters)]
+
+    def sweeps(self, outputPath):
+
+        """
+        Returns the recorded sweeps of an output file as dicts, in the order of the series in the file.
+        """
+
+        query = ("SELECT sweeps.* FROM sweeps JOIN files ON files.id = sweeps.file_id WHERE output_path = ? "
+                 "ORDER BY file_index, sweep_number")
+
+        return [dict(row) for row in self.connection.execute(query, (os.path.abspath(outputPath),))]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="List the NWB files of a conversion catalog.")
+    parser.add_argument("--date", default=None, help="Recording date as YYYY-MM-DD.")
+    parser.add_argument("--cell", default=None)
+    parser.add_argument("--layer", default=None)
+    parser.add_argument("--experimenter", default=None)
+    parser.add_argument("--protocol", default=None)
+    parser.add_argument("--clampMode", type=int, default=None,
+                        help="0: voltage clamp, 1: current clamp.")
+    parser.add_argument("catalog", help="Path of the SQLite catalog.")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.catalog):
+        raise ValueError(f"The catalog {args.catalog} does not exist.")
+
+    with ConversionCatalog(args.catalog) as catalog:
+        for entry in catalog.select(date=args.date, cell=args.cell, layer=args.layer,
+                                    experimenter=args.experimenter, protocol=args.protocol,
+                                    clampMode=args.clampMode):
+            print(f"{entry['output_path']}\t{entry['date']}\t{entry['cell']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,25 @@ import matplotlib.style as mplstyle
 import matplotlib.ticker as ticker
 from matplotlib.backends.backend_pdf import PdfPages
 
+import re
 import json
 import numpy as np
 import math
 import argparse
 import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 from pynwb import NWBHDF5IO
 
+from batch_tools import run_jobs, report_failures
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:  # The pages of a file are then rendered in a single process
+    PdfReader = PdfWriter = None
+
 """
 Taken from https://github.com/AllenInstitute/ipfx/blob/master/ipfx/bin/nwb_to_pdf.py and modified to accommodate 
 NWB v2 files created for the Neuron2BrainLab. 
@@ -22,6 +33,15 @@ Key changes:
 """
 
 
+# Resolution the traces are decimated to, that of a print of the pages, as a PDF has no
+# rendered width of its own
+DECIMATION_DPI = 300
+
+# Names of the tables of the stacked layout in the sweeps processing module, see
+# ABF1Converter._addStackedSweeps
+STACKED_TABLE = re.compile(r"(Stimulus|Acquisition)_\d+(_\d+)?$")
+
+
 def physical(number, unit):
     if math.isnan(number):
         return 'NaN'
@@ -139,6 +159,44 @@ class SingleSweep():
         return len(self.stimulus)
 
 
+class StackedSweepData():
+    '''
+    data of a StackedSweepRow, read from the 2-D dataset of its table
+    '''
+    def __init__(self, dataset, row, attributes):
+        self.dataset = dataset
+        self.row = row
+        self.attrs = {'conversion': attributes['conversion'], 'unit': attributes['unit'],
+                      'offset': attributes.get('offset', 0.0)}
+
+    def __getitem__(self, key):
+        return self.dataset[self.row][key]
+
+
+class StackedSweepRow():
+    '''
+    PatchClampSeries-like view of a sweep stored as a row of a stacked sweep table, for
+    PatchClampSeriesPlotData
+        table: Stimulus_N or Acquisition_N table of the sweeps processing module
+        row:   row of the sweep in the table
+
+    The attributes shared by all rows are read from the JSON of the table description.
+    '''
+    def __init__(self, table, row):
+        attributes = json.loads(table.description)
+
+        self.name = "%s[%d]" % (table.name, row)
+        self.neurodata_type = attributes['neurodata_type']
+        self.rate = attributes['rate']
+        self.gain = attributes['gain']
+        self.starting_time = attributes['starting_time']
+        self.time_unit = 'seconds'
+        self.stimulus_description = 'N/A'
+        self.sweep_number = table['sweep_number'].data[row]
+        self.description = json.dumps({'file_name': str(table['file_name'].data[row])})
+        self.data = StackedSweepData(table['data'].data, row, attributes)
+
+
 class PatchClampSeriesPlotData():
     '''
     Data class for storing plotting information for PatchClampSeries
@@ -158,13 +216,20 @@ class PatchClampSeriesPlotData():
         self.unit = {}
         self.axis = {}
 
-        self.data['y'] = pcs.data[()]
         attributes = pcs.data.attrs
 
         conv = attributes.get('conversion')
+        offset = attributes.get('offset', 0.0)
         unit = attributes.get('unit')
 
+        self.data['y'] = pcs.data[()]
+
+        # Raw data is stored as int16 counts
+        if not np.issubdtype(self.data['y'].dtype, np.floating):
+            self.data['y'] = self.data['y'].astype(np.float64)
+
         self.data['y'] *= conv
+        self.data['y'] += offset
         self.unit['y'] = unit
 
         if unit == "A":
@@ -230,34 +295,114 @@ class PatchClampSeriesPlotData():
             self.annotation.append("%s: %s" % (name, physical(data, unit)))
 
 
-def gather_sweeps(nwbfile):
+def stacked_tables(nwb):
     '''
-    sort PatchClampSeries according to cycle_id
+    tables of the stacked layout of an opened NWBFile, with whether they hold stimulus
+    '''
+    if 'sweeps' not in nwb.processing:
+        return []
+
+    tables = []
+    for name, table in nwb.processing['sweeps'].data_interfaces.items():
+        match = STACKED_TABLE.match(name)
+        if match is not None:
+            tables.append((table, match.group(1) == 'Stimulus'))
+    return tables
+
+
+def gather_sweeps(nwb, sweep_number=None):
+    '''
+    sort PatchClampSeries according to sweep number
+
+    The sweep number is read from the sweep_number attribute, so it also works for files
+    whose descriptions only reference a row of the sweep metadata table. The rows of the
+    stacked layout are gathered as StackedSweepRow.
+        nwb:          opened NWBFile
+        sweep_number: only load the data of the series of this sweep
     '''
     sweeps = SweepCollection()
-    with NWBHDF5IO(nwbfile, 'r') as io:
-        nwb = io.read()
-        for key in nwb.acquisition:
-            acquisition = nwb.get_acquisition(key)
-            description = json.loads(acquisition.description)
-            sweep_number = description['sweep_number']
-            sweeps.get(sweep_number).add_acquisition(key, acquisition)
-        for key in nwb.stimulus:
-            ccss = nwb.get_stimulus(key)
-            description = json.loads(ccss.description)
-            sweep_number = description['sweep_number']
-            sweeps.get(sweep_number).add_stimulus(key, ccss)
+    for key in nwb.acquisition:
+        acquisition = nwb.get_acquisition(key)
+        if sweep_number is None or int(acquisition.sweep_number) == sweep_number:
+            sweeps.get(int(acquisition.sweep_number)).add_acquisition(key, acquisition)
+    for key in nwb.stimulus:
+        ccss = nwb.get_stimulus(key)
+        if sweep_number is None or int(ccss.sweep_number) == sweep_number:
+            sweeps.get(int(ccss.sweep_number)).add_stimulus(key, ccss)
+    for table, is_stimulus in stacked_tables(nwb):
+        for row, number in enumerate(table['sweep_number'].data[:]):
+            if sweep_number is not None and int(number) != sweep_number:
+                continue
+            pcs = StackedSweepRow(table, row)
+            if is_stimulus:
+                sweeps.get(int(number)).add_stimulus(pcs.name, pcs)
+            else:
+                sweeps.get(int(number)).add_acquisition(pcs.name, pcs)
     return sweeps
 
 
+def list_sweeps(nwb):
+    '''
+    sweep numbers of an opened NWBFile in the order of SweepCollection, without loading
+    any data
+    '''
+    keys = {}
+    for key in nwb.acquisition:
+        keys.setdefault(int(nwb.get_acquisition(key).sweep_number), []).append(key)
+    for key in nwb.stimulus:
+        keys.setdefault(int(nwb.get_stimulus(key).sweep_number), [])
+    for table, is_stimulus in stacked_tables(nwb):
+        for row, number in enumerate(table['sweep_number'].data[:]):
+            names = keys.setdefault(int(number), [])
+            if not is_stimulus:
+                names.append("%s[%d]" % (table.name, row))
+    return sorted(keys, key=lambda id: sorted(keys[id]))
+
+
+def decimate_minmax(x, y, pixels):
+    '''
+    reduce a trace to the minimum and maximum of every pixel column, in the order they
+    occur, so that the line drawn looks the same as with every sample
+        x, y:   samples of the trace
+        pixels: width of the axis in pixels, see DECIMATION_DPI
+
+    The first and last samples are kept for the limits of the axis. Columns with only NaNs
+    stay NaN, so that gaps in the trace are kept.
+    '''
+    if len(y) <= 2 * pixels + 2:
+        return x, y
+
+    width = math.ceil(len(y) / pixels)
+    columns = math.ceil(len(y) / width)
+
+    padded = np.full(columns * width, np.nan)
+    padded[:len(y)] = y
+    padded = padded.reshape(columns, width)
+
+    lowest = np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    highest = np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+
+    start = np.arange(columns) * width
+    indices = np.stack((start + np.minimum(lowest, highest),
+                        start + np.maximum(lowest, highest)), axis=1).ravel()
+    indices = np.concatenate(([0], indices, [len(y) - 1]))
+
+    return x[indices], y[indices]
+
+
 def plot_patchClampSeries(axis, pcs_data_plot, length):
     '''
     plot a PatchClampSeries against the axis
         pcs_data_plot: class PatchClampSeriesPlotData
         axis:    plt.axis
         length:  number of points to plot
+
+    The trace is decimated to the width of the axis at DECIMATION_DPI, so the figure has
+    to be sized first.
     '''
-    axis.plot(pcs_data_plot.data['x'][:length - 1], pcs_data_plot.data['y'][:length-1])
+    pixels = math.ceil(axis.get_window_extent().width / axis.figure.dpi * DECIMATION_DPI)
+    axis.plot(*decimate_minmax(pcs_data_plot.data['x'][:length - 1],
+                               pcs_data_plot.data['y'][:length - 1], pixels))
     axis.set_title("%s" % pcs_data_plot.title)
     axis.set_ylabel('%s [%s]' % (pcs_data_plot.axis['y'],
                                  pcs_data_plot.unit['y']))
@@ -391,48 +536,116 @@ def check_stimset_reconstruction(nwbfile, outfile):
                 pass
 
 
-def create_regular_pdf(nwbfile, outfile):
+def min_length(sweepdata, length):
+    for pcs_data_plot in sweepdata.values():
+        length = min(length, len(pcs_data_plot.data['y']))
+
+    return length
+
+
+def create_sweep_page(sweep_number, sweep):
     '''
-    convert a NeurodataWithoutBorders file to a PortableDocumentFile
+    create the figure of the PDF page of a sweep
+        sweep: class SingleSweep
+    '''
+    nacquisition = sweep.num_acquisition()
+    nstimulus = sweep.num_stimulus()
+    ncols = max(nacquisition, nstimulus)
+
+    fig, axes = plt.subplots(nrows=2, ncols=ncols, sharex='row',
+                             num=sweep_number, squeeze=False)
+
+    # Sized before plotting, the traces are decimated to the width of the axes
+    fig.set_size_inches(8.27, 11.69)  # a4 portrait
+    fig.subplots_adjust(wspace=0.33)
+
+    length = min_length(sweep.get_stimulus(), math.inf)
+    length = min_length(sweep.get_acquisition(), length)
+
+    plot_sweepdata(sweep.get_stimulus(), axes[0], length)
+    plot_sweepdata(sweep.get_acquisition(), axes[1], length, addXTicks=True)
+
+    fig.suptitle("Sweep %s" % sweep_number)
+    plt.close(fig)
+
+    return fig
+
+
+def render_sweep_pages(nwbfile, sweep_numbers, outfile):
+    '''
+    render the pages of the given sweeps of a NWB file to a PDF, in the given order
+
+    The data of one sweep is loaded at a time, for the page it is plotted on.
     '''
 
     mplstyle.use(['ggplot', 'fast'])
 
-    sweeps = gather_sweeps(nwbfile)
+    with NWBHDF5IO(nwbfile, 'r') as io:
+        nwb = io.read()
+
+        with PdfPages(outfile) as pdf:
+            for sweep_number in sweep_numbers:
+                sweep = gather_sweeps(nwb, sweep_number).get(sweep_number)
+                pdf.savefig(create_sweep_page(sweep_number, sweep))
+
+            d = pdf.infodict()
+            d['Title'] = nwbfile
+            d['Creator'] = '/AllenInstitute/ipfx/nwb_to_pdf.py using matplotlib'
+
+    return outfile
+
+
+def create_regular_pdf(nwbfile, outfile, jobs=1):
+    '''
+    convert a NeurodataWithoutBorders file to a PortableDocumentFile
+
+    With several jobs the sweeps are split into contiguous ranges, whose pages are rendered
+    to partial PDFs by worker processes and concatenated in sweep order, which requires
+    pypdf. Raises a ValueError for a file without sweeps instead of writing an empty PDF.
+    '''
+
+    with NWBHDF5IO(nwbfile, 'r') as io:
+        sweep_numbers = list_sweeps(io.read())
 
-    def min_length(sweepdata, length):
-        for pcs_data_plot in sweepdata.values():
-            length = min(length, len(pcs_data_plot.data['y']))
+    if not sweep_numbers:
+        raise ValueError(f"{nwbfile} contains no sweeps.")
 
-        return length
+    jobs = min(jobs, len(sweep_numbers))
 
-    with PdfPages(outfile) as pdf:
-        for sweep_number in sweeps:
-            sweep = sweeps.get(sweep_number)
+    if jobs == 1 or PdfWriter is None:
+        render_sweep_pages(nwbfile, sweep_numbers, outfile)
+        return
 
-            nacquisition = sweep.num_acquisition()
-            nstimulus = sweep.num_stimulus()
-            ncols = max(nacquisition, nstimulus)
+    size = math.ceil(len(sweep_numbers) / jobs)
+    ranges = [sweep_numbers[start:start + size] for start in range(0, len(sweep_numbers), size)]
 
-            fig, axes = plt.subplots(nrows=2, ncols=ncols, sharex='row',
-                                     num=sweep_number, squeeze=False)
+    with tempfile.TemporaryDirectory() as folder:
+        partfiles = [os.path.join(folder, "%d.pdf" % index) for index in range(len(ranges))]
 
-            length = min_length(sweep.get_stimulus(), math.inf)
-            length = min_length(sweep.get_acquisition(), length)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # map returns the partial PDFs in the order of the ranges
+            partfiles = list(executor.map(render_sweep_pages, [nwbfile] * len(ranges), ranges,
+                                          partfiles))
 
-            plot_sweepdata(sweep.get_stimulus(), axes[0], length)
-            plot_sweepdata(sweep.get_acquisition(), axes[1], length, addXTicks=True)
+        writer = PdfWriter()
+        for partfile in partfiles:
+            writer.append(PdfReader(partfile))
+        writer.add_metadata(PdfReader(partfiles[0]).metadata)
+        writer.write(outfile)
 
-            fig.suptitle("Sweep %s" % sweep_number)
-            fig.set_size_inches(8.27, 11.69)  # a4 portrait
 
-            plt.subplots_adjust(wspace=0.33)
-            pdf.savefig(fig)
-            plt.close()
+def create_pdf(nwbfile, check_stimset_rec=False, jobs=1):
+    '''
+    create the PDF next to a NWB file, rendering its pages with the given number of jobs
+    '''
+    outfile = os.path.splitext(nwbfile)[0] + ".pdf"
+
+    if check_stimset_rec:
+        check_stimset_reconstruction(nwbfile, outfile)
+    else:
+        create_regular_pdf(nwbfile, outfile, jobs)
 
-        d = pdf.infodict()
-        d['Title'] = nwbfile
-        d['Creator'] = '/AllenInstitute/ipfx/nwb_to_pdf.py using matplotlib'
+    return outfile
 
 
 def main():
@@ -440,18 +653,29 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--check-stimset-rec", help="Create plot for checking " +
                         "the stimset reconstruction.", action="store_true")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of worker processes, spread over the files and the pages of each file.")
     parser.add_argument("nwbfiles", help="Path to input NWB files.", type=str,
                         nargs="+")
     args = parser.parse_args()
 
-    for nwbfile in args.nwbfiles:
-        outfile = os.path.splitext(nwbfile)[0] + ".pdf"
-        print("Creating PDF for {nwbfile}")
+    if args.jobs < 1:
+        raise ValueError(f"Invalid number of jobs {args.jobs}: must be at least 1.")
 
-        if args.check_stimset_rec:
-            check_stimset_reconstruction(nwbfile, outfile)
-        else:
-            create_regular_pdf(nwbfile, outfile)
+    # Jobs left over by fewer files than jobs render the pages of each file
+    file_jobs = min(args.jobs, len(args.nwbfiles))
+    page_jobs = args.jobs // file_jobs
+
+    tasks = {nwbfile: (nwbfile, args.check_stimset_rec, page_jobs) for nwbfile in args.nwbfiles}
+    failures = {}
+
+    for nwbfile, outfile in run_jobs(create_pdf, tasks, failures, file_jobs, action="create the PDF for"):
+        print(f"Created {outfile} for {nwbfile}")
+
+    report_failures(failures)
+
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
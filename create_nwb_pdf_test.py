@@ -0,0 +1,91 @@
+import os
+import re
+import json
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+from dateutil.tz import tzlocal
+from pynwb import NWBHDF5IO, NWBFile
+from pynwb.icephys import CurrentClampSeries, CurrentClampStimulusSeries
+
+import create_nwb_pdf
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+
+def write_sweeps(nwbfile, sweepCount, sampleCount=2000, rate=10000.0):
+    """
+    Writes an NWB file with a stimulus and an acquisition series for each of sweepCount sweeps.
+    """
+
+    nwb = NWBFile(session_description="PDF test", identifier="create_nwb_pdf_test",
+                  session_start_time=datetime(2018, 4, 17, tzinfo=tzlocal()))
+    device = nwb.create_device(name="Amplifier")
+    electrode = nwb.create_icephys_electrode(name="elec0", description="Test electrode", device=device)
+    time = np.arange(sampleCount) / rate
+
+    for sweepNumber in range(sweepCount):
+        description = json.dumps({"file": "test.abf", "sweep": sweepNumber})
+        nwb.add_stimulus(CurrentClampStimulusSeries(
+            name=f"Index_{sweepNumber}_0_0", data=np.where(time > 0.05, 1e-10 * sweepNumber, 0.0),
+            unit="amperes", electrode=electrode, gain=1.0, rate=rate, starting_time=0.0,
+            description=description, sweep_number=sweepNumber, stimulus_description="step"))
+        nwb.add_acquisition(CurrentClampSeries(
+            name=f"Index_{sweepNumber}_0_0", data=-0.07 + 0.01 * np.sin(2 * np.pi * sweepNumber * time),
+            unit="volts", electrode=electrode, gain=1.0, rate=rate, starting_time=0.0,
+            description=description, sweep_number=sweepNumber, stimulus_description="step"))
+
+    with NWBHDF5IO(nwbfile, "w") as io:
+        io.write(nwb)
+
+
+def page_content(page):
+    """
+    Returns the content stream of a PDF page with the font resources replaced by the names of their fonts, as
+    each partial PDF numbers and subsets its fonts on its own.
+    """
+
+    fonts = page["/Resources"].get("/Font", {})
+
+    def fontName(match):
+        # Subset fonts are named with a tag of their glyphs, e.g. /ABCDEF+DejaVuSans
+        name = fonts[match.group(1).decode()]["/BaseFont"].split("+")[-1]
+        return name.encode() + match.group(2)
+
+    return re.sub(rb"(/F\d+)( [\d.]+ Tf)", fontName, page.get_contents().get_data())
+
+
+@unittest.skipIf(PdfReader is None, "Rendering the pages of a file with several jobs requires pypdf.")
+class ParallelPagesTest(unittest.TestCase):
+
+    def test_jobs_match_serial_pages(self):
+
+        with tempfile.TemporaryDirectory() as folder:
+            nwbfile = os.path.join(folder, "cell.nwb")
+            write_sweeps(nwbfile, 7)
+
+            serialFile = os.path.join(folder, "serial.pdf")
+            parallelFile = os.path.join(folder, "parallel.pdf")
+            create_nwb_pdf.create_regular_pdf(nwbfile, serialFile)
+            create_nwb_pdf.create_regular_pdf(nwbfile, parallelFile, jobs=3)
+
+            serial, parallel = PdfReader(serialFile), PdfReader(parallelFile)
+
+            self.assertEqual(len(serial.pages), 7)
+            self.assertEqual(len(parallel.pages), len(serial.pages))
+
+            for serialPage, parallelPage in zip(serial.pages, parallel.pages):
+                self.assertEqual(parallelPage.extract_text(), serialPage.extract_text())
+                self.assertEqual(page_content(parallelPage), page_content(serialPage))
+
+            for key in ["/Title", "/Creator"]:
+                self.assertEqual(parallel.metadata[key], serial.metadata[key])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/bin/env python
+
+import os
+import argparse
+
+from pynwb import NWBHDF5IO
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from pynwb.core import VectorData
+from pynwb.icephys import PatchClampSeries
+
+from ABF1Converter import COMPRESSION_PROFILES, getCompressionArguments
+
+try:
+    from hdmf_zarr.nwb import NWBZarrIO
+except ImportError:  # Reported when converting
+    NWBZarrIO = None
+
+
+def hdf5_to_zarr(inputFile, outputPath):
+    """
+    Exports an NWB file to a zarr directory store with the same structure.
+
+    hdmf-zarr carries the chunking and the gzip compression of the HDF5 datasets over to the zarr arrays.
+    """
+
+    with NWBHDF5IO(inputFile, "r") as readIO, NWBZarrIO(outputPath, "w") as exportIO:
+        exportIO.export(src_io=readIO, write_args=dict(link_data=False))
+
+
+def zarr_to_hdf5(inputPath, outputFile, compression="default"):
+    """
+    Exports a zarr directory store to an NWB file with the same structure.
+
+    The zarr codecs have no HDF5 counterpart, so the sweep data of the series and of the stacked sweep tables is
+    compressed with the given profile of COMPRESSION_PROFILES instead.
+    """
+
+    with NWBZarrIO(inputPath, "r") as readIO, NWBHDF5IO(outputFile, "w") as exportIO:
+        nwbFile = readIO.read()
+
+        for container in nwbFile.objects.values():
+            if isinstance(container, PatchClampSeries) or (isinstance(container, VectorData)
+                                                            and container.name == "data"):
+                settings = getCompressionArguments(container.data, COMPRESSION_PROFILES[compression])
+                container.set_data_io("data", H5DataIO, data_io_kwargs=settings)
+                container.set_modified()
+
+        exportIO.export(src_io=readIO, nwbfile=nwbFile, write_args=dict(link_data=False))
+
+
+def convert_store(inputPath, outputPath, overwrite=False, compression="default"):
+    """
+    Converts between an NWB file and a zarr directory store, in the direction given by the input: a directory
+    is read as a zarr store and written as an NWB file with the given compression profile, a file the other
+    way around.
+    """
+
+    if NWBZarrIO is None:
+        raise ImportError("Converting zarr directory stores requires hdmf-zarr.")
+
+    if not os.path.exists(inputPath):
+        raise ValueError(f"The file or folder {inputPath} does not exist.")
+
+    if os.path.exists(outputPath) and not overwrite:
+        raise ValueError(f"The file or folder {outputPath} already exists.")
+
+    if os.path.isdir(inputPath):
+        zarr_to_hdf5(inputPath, outputPath, compression)
+    else:
+        hdf5_to_zarr(inputPath, outputPath)
+
+    print(f"Successfully converted {inputPath} to {outputPath}.")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Convert between NWB files and zarr directory stores.")
+    parser.add_argument("--overwrite", action="store_true", default=False,
+                        help="Overwrite the output file or store.")
+    parser.add_argument("--compression", default="default", choices=list(COMPRESSION_PROFILES),
+                        help="Compression profile of the sweep data when writing an NWB file.")
+    parser.add_argument("inputPath", help="NWB file, or zarr directory store, to convert.")
+    parser.add_argument("outputPath", help="Zarr directory store, or NWB file, to write.")
+
+    args = parser.parse_args()
+
+    convert_store(args.inputPath, args.outputPath, overwrite=args.overwrite, compression=args.compression)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+#!/bin/env python
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from functools import partial
+
+import h5py
+import numpy as np
+import pyabf
+
+try:
+    import zarr
+except ImportError:  # Only needed for zarr directory stores
+    zarr = None
+
+from ABF1Reader import ABF1Reader
+from batch_tools import run_jobs
+
+# Number of samples of a sweep compared at once
+VERIFY_CHUNK_SAMPLES = 65536
+
+# Factors from the units of the ABF channels to the SI units of the series, as applied by ABF1Converter
+UNIT_CONVERSIONS = {"V": 1.0, "mV": 1e-3, "A": 1.0, "pA": 1e-12}
+
+SERIES_NAME = re.compile(r"Index_(\d+)_(\d+)_(\d+)$")
+TABLE_NAME = re.compile(r"(Stimulus|Acquisition)_(\d+)(_\d+)?$")
+
+
+def open_output(nwbPath):
+    """
+    Opens an NWB file, or a zarr directory store, for reading its datasets directly.
+    """
+
+    if not os.path.isdir(nwbPath):
+        return h5py.File(nwbPath, "r")
+
+    if zarr is None:
+        raise ImportError("Verifying zarr directory stores requires zarr.")
+
+    return zarr.open_group(nwbPath, mode="r")
+
+
+def as_str(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def list_sweeps(output):
+    """
+    Returns the sweep data stored in an opened output as (name, file name, sweep number, channel index,
+    isStimulus, dataset, row, conversion, offset) tuples.
+
+    Covers the Index_{idx}_{i}_{ch} series, whose file is named in their description or in the sweep table,
+    and the rows of the stacked sweep tables, where row is the row of the sweep in the 2-D dataset.
+    """
+
+    sweeps = []
+
+    for isStimulus, groupPath in [(True, "stimulus/presentation"), (False, "acquisition")]:
+        if groupPath not in output:
+            continue
+
+        for name, series in output[groupPath].items():
+            match = SERIES_NAME.match(name)
+            if match is None:
+                continue
+
+            description = json.loads(as_str(series.attrs["description"]))
+
+            if "file_name" in description:
+                fileName = description["file_name"]
+            else:
+                fileName = as_str(output["processing/sweeps/metadata/file_name"][description["sweep_metadata_row"]])
+
+            data = series["data"]
+            sweeps += [(f"{groupPath}/{name}", fileName, int(match.group(2)), int(match.group(3)), isStimulus,
+                        data, None, float(data.attrs["conversion"]), float(data.attrs.get("offset", 0.0)))]
+
+    if "processing/sweeps" in output:
+        for name, table in output["processing/sweeps"].items():
+            match = TABLE_NAME.match(name)
+            if match is None:
+                continue
+
+            scaling = json.loads(as_str(table.attrs["description"]))
+            fileNames = [as_str(fileName) for fileName in table["file_name"][:]]
+
+            for row, sweepNumber in enumerate(table["sweep_number"][:]):
+                sweeps += [(f"processing/sweeps/{name}[{row}]", fileNames[row], int(sweepNumber),
+                            int(match.group(2)), match.group(1) == "Stimulus", table["data"], row,
+                            float(scaling["conversion"]), float(scaling.get("offset", 0.0)))]
+
+    return sweeps
+
+
+def find_abf_files(abfPath):
+    """
+    Returns the paths of the ABF files in a file or folder by file name, as lists, since files in different cell
+    folders can share a name.
+    """
+
+    if os.path.isfile(abfPath):
+        return {os.path.basename(abfPath): [abfPath]}
+
+    abfFiles = {}
+    for dirpath, dirnames, filenames in os.walk(abfPath):
+        for fileName in filenames:
+            if fileName.endswith(".abf"):
+                abfFiles.setdefault(fileName, [])
+                abfFiles[fileName] += [os.path.join(dirpath, fileName)]
+
+    return abfFiles
+
+
+def resolve_abf_files(fileNames, abfFiles):
+    """
+    Returns the path of every file name of an output which is found in abfFiles, as given by find_abf_files.
+
+    A name shared by several ABF files is resolved to the one in the cell folder of the output, the only folder
+    holding all of its files. Raises a ValueError if there is no such folder, rather than comparing against a
+    file of another cell.
+    """
+
+    found = [fileName for fileName in sorted(fileNames) if fileName in abfFiles]
+
+    cellFolders = None
+    for fileName in found:
+        folders = {os.path.dirname(path) for path in abfFiles[fileName]}
+        cellFolders = folders if cellFolders is None else cellFolders & folders
+
+    paths = {}
+    for fileName in found:
+        candidates = abfFiles[fileName]
+
+        if len(candidates) > 1:
+            candidates = [path for path in candidates if os.path.dirname(path) in cellFolders]
+
+        if len(candidates) != 1:
+            raise ValueError(f"{fileName} matches several ABF files which can not be told apart by their cell "
+                             f"folder: {', '.join(sorted(abfFiles[fileName]))}")
+
+        paths[fileName] = candidates[0]
+
+    return paths
+
+
+def verify_file(nwbPath, abfFiles, rtol=1e-5, atol=0.0, stimulusChannelName=None):
+    """
+    Compares the sweep data of an NWB file, or zarr store, with the ABF files it was converted from.
+
+    abfFiles are the paths of the ABF files by file name, see resolve_abf_files. Each sweep is streamed in chunks
+    from both sides, the stored data is scaled with the conversion and offset of its dataset and compared vectorized
+    against the ABF data in SI units, with NaNs comparing equal. Stimulus series are compared with the command
+    waveform of their channel, or with the ADC channel stimulusChannelName where the stimulus was recorded as well.
+
+    Returns a report with the mismatching sweeps and the ABF sweeps which have no acquisition series.
+    """
+
+    startTime = time.perf_counter()
+    mismatches = []
+    missing = []
+    sampleCount = 0
+
+    abfs = {}
+    readers = {}
+    stored = set()
+
+    with open_output(nwbPath) as output:
+        sweeps = list_sweeps(output)
+        sources = resolve_abf_files({fileName for _, fileName, *_ in sweeps}, abfFiles)
+
+        for name, fileName, sweepNumber, channelIndex, isStimulus, data, row, conversion, offset in sweeps:
+
+            if fileName not in abfs:
+                if fileName not in sources:
+                    missing += [f"{fileName}: source of {name} not found"]
+                    abfs[fileName] = None
+                    continue
+
+                abfs[fileName] = pyabf.ABF(sources[fileName], loadData=False)
+                readers[fileName] = ABF1Reader(abfs[fileName])
+
+            abf = abfs[fileName]
+            if abf is None:
+                continue
+
+            if not isStimulus:
+                stored.add((fileName, sweepNumber))
+
+            isADC = not isStimulus or (stimulusChannelName is not None and stimulusChannelName in abf.adcNames)
+
+            if isADC:
+                unit = abf._getAdcNameAndUnits(channelIndex)[1]
+                readExpected = lambda start, stop: readers[fileName].sweep(sweepNumber, channelIndex, start, stop)
+            else:
+                # The command waveform is generated as a whole, as by the converter
+                unit = abf._getDacNameAndUnits(channelIndex)[1]
+                waveform = abf.stimulusByChannel[channelIndex].stimulusWaveform(sweepNumber)[:abf.sweepPointCount]
+                readExpected = lambda start, stop: waveform[start:stop]
+
+            unitConversion = UNIT_CONVERSIONS.get(unit, 1.0)
+            length = abf.sweepPointCount
+            storedLength = data.shape[-1]
+
+            if storedLength != length:
+                mismatches += [{"series": name, "error": f"{storedLength} samples stored, {length} in the ABF file"}]
+                continue
+
+            mismatched = 0
+            maxDifference = 0.0
+            firstSample = None
+
+            for start in range(0, length, VERIFY_CHUNK_SAMPLES):
+                stop = min(start + VERIFY_CHUNK_SAMPLES, length)
+
+                chunk = data[start:stop] if row is None else data[row, start:stop]
+                actual = np.asarray(chunk, dtype=np.float64) * conversion + offset
+                expected = np.asarray(readExpected(start, stop), dtype=np.float64) * unitConversion
+
+                close = np.isclose(actual, expected, rtol=rtol, atol=atol, equal_nan=True)
+
+                if not close.all():
+                    wrong = np.flatnonzero(~close)
+                    if firstSample is None:
+                        firstSample = start + int(wrong[0])
+                    mismatched += len(wrong)
+
+                    # A NaN on one side only counts as an infinite difference
+                    differences = np.nan_to_num(np.abs(actual[wrong] - expected[wrong]), nan=np.inf)
+                    maxDifference = max(maxDifference, float(differences.max()))
+
+            sampleCount += length
+
+            if mismatched:
+                mismatches += [{"series": name, "samples": mismatched, "first_sample": firstSample,
+                                "max_difference": maxDifference}]
+
+    for fileName, abf in abfs.items():
+        if abf is None:
+            continue
+
+        missing += [f"{fileName}: sweep {i} has no acquisition series" for i in range(abf.sweepCount)
+                    if (fileName, i) not in stored]
+
+    for reader in readers.values():
+        reader.close()
+
+    return {"nwb": nwbPath,
+            "sweeps": len(sweeps),
+            "samples": sampleCount,
+            "mismatches": mismatches,
+            "missing": missing,
+            "seconds": time.perf_counter() - startTime}
+
+
+def find_outputs(nwbPath):
+    """
+    Returns the NWB files and zarr stores of a file or folder.
+    """
+
+    if os.path.isfile(nwbPath) or nwbPath.endswith(".zarr"):
+        return [nwbPath]
+
+    return sorted([os.path.join(nwbPath, name) for name in os.listdir(nwbPath)
+                   if name.endswith(".nwb") or name.endswith(".nwb.zarr")])
+
+
+def verify(abfPath, nwbPath, jobs=1, rtol=1e-5, atol=0.0, stimulusChannelName=None):
+    """
+    Verifies every NWB file, or zarr store, of a file or folder against the ABF files of a file or folder,
+    one file after the other, or with jobs files checked concurrently in a process pool.
+
+    Prints a line per output file and returns the reports of the outputs which failed.
+    """
+
+    if not os.path.exists(abfPath):
+        raise ValueError(f"The file or folder {abfPath} does not exist.")
+
+    if not os.path.exists(nwbPath):
+        raise ValueError(f"The file or folder {nwbPath} does not exist.")
+
+    if jobs < 1:
+        raise ValueError(f"Invalid number of jobs {jobs}: must be at least 1.")
+
+    abfFiles = find_abf_files(abfPath)
+    outputs = {os.path.basename(output): output for output in find_outputs(nwbPath)}
+    tasks = {name: (output, abfFiles) for name, output in outputs.items()}
+    failures = {}
+    errors = {}
+    samples = 0
+    startTime = time.perf_counter()
+
+    verifyFile = partial(verify_file, rtol=rtol, atol=atol, stimulusChannelName=stimulusChannelName)
+
+    for name, report in run_jobs(verifyFile, tasks, errors, jobs, action="verify"):
+        samples += report["samples"]
+
+        if report["mismatches"] or report["missing"] or report["sweeps"] == 0:
+            failures[name] = report
+            print(f"{name}: {len(report['mismatches'])} mismatching and {len(report['missing'])} missing "
+                  f"of {report['sweeps']} sweeps")
+
+            for mismatch in report["mismatches"]:
+                print(f"  {mismatch}")
+            for message in report["missing"]:
+                print(f"  {message}")
+        else:
+            print(f"{name}: {report['sweeps']} sweeps match ({report['seconds']:.1f} s)")
+
+    for name, error in errors.items():
+        failures[name] = {"nwb": outputs[name], "error": str(error)}
+
+    elapsed = time.perf_counter() - startTime
+    megabytes = samples * 2 / 1e6
+
+    print(f"Verified {len(outputs) - len(failures)} of {len(outputs)} files in {elapsed:.1f} s: "
+          f"{megabytes / elapsed:.2f} MB/s of ABF data.")
+
+    return failures
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Verify NWB files against the ABF files they were converted from.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of files to verify concurrently.")
+    parser.add_argument("--rtol", type=float, default=1e-5,
+                        help="Relative tolerance of the comparison.")
+    parser.add_argument("--atol", type=float, default=0.0,
+                        help="Absolute tolerance of the comparison, in SI units.")
+    parser.add_argument("--stimulusChannelName", default=None,
+                        help="ADC channel the stimulus series were converted from, as given to abf_to_nwb.py.")
+    parser.add_argument("abfPath", help="ABF file or folder of ABF files.")
+    parser.add_argument("nwbPath", help="NWB file, zarr store, or folder of these.")
+
+    args = parser.parse_args()
+
+    failures = verify(args.abfPath, args.nwbPath, jobs=args.jobs, rtol=args.rtol, atol=args.atol,
+                      stimulusChannelName=args.stimulusChannelName)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
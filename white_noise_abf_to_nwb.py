@@ -1,9 +1,85 @@
 import os
 import sys
+import time
+import argparse
 from datetime import datetime
 from ABF1Converter import ABF1Converter
+from conversion_catalog import ConversionCatalog
+from batch_tools import run_jobs, report_failures
 
-def abf_to_nwb(inputPath, outFolder):
+def parse_date(dateStr):
+
+    """
+    Returns the date of a "Month Day, Year" folder name, with the month written out or abbreviated.
+    """
+
+    for fmt in ["%B %d, %Y", "%b %d, %Y"]:
+        try:
+            return datetime.strptime(dateStr, fmt).date()
+        except ValueError:
+            pass
+
+    raise ValueError("The file hierarchy is not compatible: date must be present.")
+
+
+def find_cells(inputPath, outFolder):
+
+    """
+    Walks the "../Month Day, Year/Cell #/" hierarchy once and returns the cell folders with their output files,
+    dates and cell numbers, parsing the date of every date folder only once.
+
+    Raises before anything is converted if an output file already exists, or if two cell folders map to the same
+    output file, as under date folders which spell the same date differently.
+    """
+
+    cells = []
+    outFiles = {}
+
+    for dirpath, dirnames, filenames in os.walk(inputPath):
+
+        cellNames = [s for s in dirnames if "Cell" in s]
+        if len(cellNames) == 0:
+            continue
+
+        # Create uniform datetime object for file name consistency
+        date = str(parse_date(os.path.split(dirpath)[-1]))
+
+        for cell in cellNames:
+
+            cellNumber = cell[5:]
+
+            # Create NWB file for each cell (YYYY-MM-DD-C#.nwb)
+            outFile = os.path.join(outFolder, date + "-" + f"C{cellNumber}" + ".nwb")
+
+            if os.path.exists(outFile):
+                raise ValueError(f"The file {outFile} already exists.")
+
+            cellFolder = os.path.join(dirpath, cell)
+
+            if outFile in outFiles:
+                raise ValueError(f"The cell folders {outFiles[outFile]} and {cellFolder} both map to {outFile}.")
+
+            outFiles[outFile] = cellFolder
+            cells += [(cellFolder, outFile, date, cellNumber)]
+
+    return cells
+
+
+def convert_cell(cellFolder, outFile):
+
+    """
+    Converts the ABF files of one cell folder to an NWB file and returns the time it took, and the paths of the
+    ABF files in the order they were converted.
+    """
+
+    startTime = time.perf_counter()
+    conv = ABF1Converter(cellFolder, outFile)
+    conv.convert()
+
+    return time.perf_counter() - startTime, [abfFile.abfFilePath for abfFile in conv.abfFiles]
+
+
+def abf_to_nwb(inputPath, outFolder, jobs=1, catalog=None):
 
     """
     Takes the path to the ABF v1 file(s) as the first command line argument and writes the corresponding NWB file(s)
@@ -11,6 +87,13 @@ def abf_to_nwb(inputPath, outFolder):
 
     NWB Files organized by cell, and must have directories in the form "../Month Day, Year/Cell #/"
 
+    All cells are found before converting. With jobs > 1 the cells are converted concurrently in a process pool.
+    In both modes a failing cell is reported and the remaining cells are still converted.
+    Returns the errors of the failed cells by output file name.
+
+    With catalog, the converted cells and their sweeps are recorded in the SQLite conversion catalog at the given
+    path, in one transaction at the end.
+
     """
 
     if not os.path.exists(inputPath):
@@ -54,48 +137,52 @@ def abf_to_nwb(inputPath, outFolder):
 
     else:
 
-        date = ""
-        for dirpath, dirnames, filenames in os.walk(inputPath):
+        cells = {os.path.basename(outFile): (cellFolder, outFile, date, cellNumber)
+                 for cellFolder, outFile, date, cellNumber in find_cells(inputPath, outFolder)}
+        tasks = {cellName: (cellFolder, outFile) for cellName, (cellFolder, outFile, _, _) in cells.items()}
+        failures = {}
+        converted = []
 
-            # Create NWB file for each cell (YYYY.MM.DD.C#.nwb)
-            cells = [s for s in dirnames if "Cell" in s]
-            for cell in cells:
+        startTime = time.perf_counter()
 
-                cellFolder = os.path.join(dirpath, cell)
+        for cellName, (elapsed, abfFilePaths) in run_jobs(convert_cell, tasks, failures, jobs):
+            _, outFile, date, cellNumber = cells[cellName]
+            converted += [(outFile, abfFilePaths, date, cellNumber)]
+            print(f"Converted {cellName} in {elapsed:.1f} s.")
 
-                # Create uniform datetime object for file name consistency
-                dateStr = os.path.split(dirpath)[-1]
-                failCount = 0
-                for fmt in ["%B %d, %Y", "%b %d, %Y"]:
-                    try:
-                        dt = datetime.strptime(dateStr, fmt)
-                    except:
-                        failCount += 1
-                        pass
+        elapsed = time.perf_counter() - startTime
+        print(f"Converted {len(cells) - len(failures)} of {len(cells)} cells in {elapsed:.1f} s.")
 
-                if failCount > 1:
-                    raise ValueError("The file hierarchy is not compatible: date must be present.")
+        report_failures(failures, noun="cell")
 
-                date = str(dt.date())
+        if catalog is not None:
+            with ConversionCatalog(catalog) as conversionCatalog:
+                for outFile, abfFilePaths, date, cellNumber in converted:
+                    conversionCatalog.record(outFile, abfFilePaths, date=date, cell=f"C{cellNumber}")
 
-                cellNumber = cell[5:]
+        return failures
 
-                # Create an NWB v2 file (MM-DD-YY-C#.nwb)
-                outFile = os.path.join(outFolder, date + "-" + f"C{cellNumber}" + ".nwb")
 
-                if os.path.exists(outFile):
-                    raise ValueError(f"The file {outFile} already exists.")
+def main():
 
-                ABF1Converter(cellFolder, outFile).convert()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of cells to convert concurrently.")
+    parser.add_argument("--catalog", default=None,
+                        help="SQLite conversion catalog to record the converted cells and their sweeps in.")
+    parser.add_argument("inputPath", help="Folder with the \"Month Day, Year/Cell #/\" hierarchy to convert.")
+    parser.add_argument("outputPath", help="Output path for the nwb files.")
 
-    return True
+    args = parser.parse_args()
 
+    if args.jobs < 1:
+        raise ValueError(f"Invalid number of jobs {args.jobs}: must be at least 1.")
 
-def main():
+    failures = abf_to_nwb(args.inputPath, args.outputPath, jobs=args.jobs, catalog=args.catalog)
 
-    inputPath = sys.argv[1]
-    outputPath = sys.argv[2]
-    abf_to_nwb(inputPath, outputPath)
+    if failures:
+        sys.exit(1)
 
 
-main()
+if __name__ == "__main__":
+    main()